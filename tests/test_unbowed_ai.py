@@ -1,26 +1,67 @@
+import asyncio
+import json
+import multiprocessing
 import os
 import pickle
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import Any
+from pathlib import Path
+from typing import Any, List
 from unittest import IsolatedAsyncioTestCase
 
 import numpy as np
+import pytest
 import requests
 from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings.fake import FakeEmbeddings
 from langchain.llms import OpenAI
 from langchain.llms.fake import FakeListLLM
+from langchain.memory import ConversationBufferMemory
 from langchain.prompts import PromptTemplate
 
 from unbowed_ai import Answer, Docs, PromptCollection, Text
-from unbowed_ai.chains import get_score
-from unbowed_ai.readers import read_doc
-from unbowed_ai.types import Doc
+from unbowed_ai.cache import (
+    AnswerCache,
+    EmbeddingCache,
+    MemorySummaryCache,
+    ParseCache,
+    QueryEmbeddingCache,
+    SQLiteSummaryCache,
+    SummaryCache,
+)
+from unbowed_ai.chains import get_score, make_chain, parse_batch_summaries
+from unbowed_ai.lexical import (
+    InvertedIndex,
+    bm25_scores,
+    reciprocal_rank_fusion,
+    tokenize,
+)
+from unbowed_ai.limiter import AdaptiveLimiter, TokenBucket
+from unbowed_ai.readers import iter_doc, read_doc
+from unbowed_ai.types import Context, Doc
 from unbowed_ai.utils import (
+    gather_until,
+    get_embedding_name,
+    get_loop,
     maybe_is_html,
     maybe_is_text,
+    md5sum,
     name_in_text,
+    run_sync,
     strings_similarity,
 )
+from unbowed_ai.vectorstores import EmbeddingStore, IDMapFAISS
+
+
+@pytest.fixture(autouse=True)
+def in_tmp_path(tmp_path, monkeypatch):
+    # files written by tests (e.g. example.txt) go in a temporary directory
+    monkeypatch.chdir(tmp_path)
 
 
 class TestHandler(AsyncCallbackHandler):
@@ -217,6 +258,146 @@ def test_extract_score():
     assert get_score(sample) == 5
 
 
+def test_parse_batch_summaries():
+    output = """Here you go:
+    [{"excerpt": 1, "summary": "The vaccine is 90% effective.", "score": 9},
+     {"excerpt": 3, "summary": "Not applicable", "score": 1},
+     {"excerpt": 7, "summary": "Out of range", "score": 5},
+     {"summary": "No excerpt"}]"""
+    summaries = parse_batch_summaries(output, 3)
+    assert set(summaries) == {0, 2}
+    assert get_score(summaries[0]) == 9
+    assert summaries[2].startswith("Not applicable")
+    assert parse_batch_summaries("I cannot do that", 3) == {}
+
+
+def test_batch_evidence():
+    doc_path = "example.html"
+    with open(doc_path, "w", encoding="utf-8") as f:
+        # get wiki page about politician
+        r = requests.get("https://en.wikipedia.org/wiki/Frederick_Bates_(politician)")
+        f.write(r.text)
+    docs = Docs(batch_summaries=True)
+    docs.add(doc_path, "WikiMedia Foundation, 2023, Accessed now")
+    evidence = docs.get_evidence(
+        Answer(question="For which state was Bates a governor?"), k=5, max_sources=3
+    )
+    assert "Missouri" in evidence.context
+    os.remove(doc_path)
+
+
+def test_batch_evidence_same_names():
+    class EchoLLM(FakeListLLM):
+        """Summarizes each excerpt as its own text."""
+
+        def _call(self, prompt: str, *args: Any, **kwargs: Any) -> str:
+            excerpts = re.findall(r"Excerpt (\d+) from [^\n]*:\n(.*)", prompt)
+            return json.dumps(
+                [{"excerpt": int(i), "summary": t, "score": 8} for i, t in excerpts]
+            )
+
+        async def _acall(self, prompt: str, *args: Any, **kwargs: Any) -> str:
+            return self._call(prompt)
+
+    llm = EchoLLM(responses=[""])
+    docs = Docs(
+        llm=llm,
+        embeddings=FakeEmbeddings(size=16),
+        embedding_cache=None,
+        batch_summaries=True,
+    )
+    doc = Doc(docname="Doc", citation="Author, Title, 2023", dockey="doc")
+    # chunks of the same pages share a name
+    texts = [Text(text=f"Fact {i}", name="Doc pages 1-2", doc=doc) for i in range(4)]
+    docs.add_texts(texts, doc)
+    evidence = docs.get_evidence(
+        Answer(question="Which facts?"), k=4, max_sources=4, marginal_relevance=False
+    )
+    assert len(evidence.contexts) == 4
+    for c in evidence.contexts:
+        assert c.context.startswith(c.text.text)
+
+
+def test_bm25_scores():
+    assert tokenize("What is the Score of GPT-4?") == ["score", "gpt"]
+    scores = bm25_scores(
+        "What is explainable AI?",
+        ["Explainable AI methods", "The cat sat on the mat", "AI is here"],
+    )
+    assert scores[0] > scores[2] > scores[1] == 0
+    assert bm25_scores("anything", []) == []
+
+
+def test_inverted_index():
+    index = InvertedIndex()
+    index.add([0, 1], ["SCO 211 meets on Wednesday", "SCO 212 meets on Friday"])
+    index.add([5], ["Office hours for SCO 211 are on Monday"])
+    assert [i for i, _ in index.search("When does SCO 211 meet?", 2)] == [0, 5]
+    assert [i for i, _ in index.search("SCO 211", 5, id_ranges=[(2, 10)])] == [5]
+    assert index.search("nothing matches", 5) == []
+    index.delete([0])
+    assert len(index) == 2
+    assert [i for i, _ in index.search("SCO 211", 5)] == [5, 1]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index.save(Path(tmpdir))
+        loaded = InvertedIndex.load(Path(tmpdir))
+        assert loaded.search("SCO 211", 5) == index.search("SCO 211", 5)
+        loaded.add([6], ["SCO 211 exam"])
+        assert {i for i, _ in loaded.search("SCO 211", 5)} == {1, 5, 6}
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "d"]], key=str)
+    assert fused[0] == "c"
+    assert set(fused) == {"a", "b", "c", "d"}
+
+
+def test_hybrid_search():
+    doc_path = "example.txt"
+    with open(doc_path, "w", encoding="utf-8") as f:
+        f.write("Lorem ipsum filler text about nothing. " * 200)
+        f.write("The course SCO 211 meets on Wednesday at noon.")
+        f.write("More filler content here. " * 300)
+    docs = Docs(hybrid_search=True)
+    docs.add(doc_path, "Course catalog, 2023", chunk_chars=500)
+    os.remove(doc_path)
+    assert len(docs.inverted_index) == len(docs.texts)
+    answer = docs.get_evidence(
+        Answer(question="When does SCO 211 meet?"), k=3, max_sources=3
+    )
+    assert any("SCO 211" in c.text.text for c in answer.contexts)
+
+
+def test_hybrid_search_same_names():
+    docs = Docs(
+        hybrid_search=True, embeddings=FakeEmbeddings(size=16), embedding_cache=None
+    )
+    doc = Doc(docname="Doc", citation="Author, Title, 2023", dockey="doc")
+    # chunks of the same pages share a name
+    texts = [
+        Text(text=f"SCO 211 meets on day {i}", name="Doc pages 1-2", doc=doc)
+        for i in range(4)
+    ]
+    docs.add_texts(texts, doc)
+    answer = docs.get_evidence(
+        Answer(question="When does SCO 211 meet?"),
+        k=4,
+        max_sources=4,
+        marginal_relevance=False,
+        disable_summarization=True,
+    )
+    assert sorted(c.text.text for c in answer.contexts) == [t.text for t in texts]
+
+
+def test_prefilter():
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    docs = Docs(prefilter=0.5)
+    docs.add(doc_path, "Wellawatte et al, XAI Review, 2023")
+    answer = docs.get_evidence(
+        Answer(question="What are counterfactual explanations?"), k=10
+    )
+    assert answer.pruned > 0
+    assert len(answer.contexts) > 0
+
+
 def test_docs():
     llm = OpenAI(client=None, temperature=0.1, model="text-ada-001")
     docs = Docs(llm=llm)
@@ -296,6 +477,170 @@ class Test(IsolatedAsyncioTestCase):
         )
         await docs.aquery("What is Frederick Bates's greatest accomplishment?")
 
+    async def test_aquery_stream(self):
+        docs = Docs(llm=ChatOpenAI(streaming=True, client=None))
+        docs.add_url(
+            "https://en.wikipedia.org/wiki/Frederick_Bates_(politician)",
+            citation="WikiMedia Foundation, 2023, Accessed now",
+            dockey="test",
+        )
+        events = [
+            e
+            async for e in docs.aquery_stream(
+                "What is Frederick Bates's greatest accomplishment?"
+            )
+        ]
+        answer = events[-1]
+        assert isinstance(answer, Answer)
+        # evidence, then tokens of the answer
+        contexts = [e for e in events if isinstance(e, Context)]
+        assert all(c in contexts for c in answer.contexts)
+        assert events[: len(contexts)] == contexts
+        tokens = events[len(contexts) : -1]
+        assert len(tokens) > 1
+        assert "".join(tokens) == answer.answer
+
+    async def test_aquery_stream_early_contexts(self):
+        class SlowLLM(FakeListLLM):
+            """Summarizes Fact 0 at once and the other facts slowly."""
+
+            async def _acall(self, prompt: str, *args: Any, **kwargs: Any) -> str:
+                if "Fact 0" not in prompt:
+                    await asyncio.sleep(0.5)
+                return "It is relevant. 8"
+
+        docs = Docs(
+            llm=FakeListLLM(responses=["The answer"]),
+            summary_llm=SlowLLM(responses=[""]),
+            embeddings=FakeEmbeddings(size=16),
+            embedding_cache=None,
+        )
+        doc = Doc(docname="Doc", citation="Author, Title, 2023", dockey="doc")
+        texts = [Text(text=f"Fact {i}", name=f"Doc{i}", doc=doc) for i in range(3)]
+        docs.add_texts(texts, doc)
+        start = time.perf_counter()
+        events = []
+        async for e in docs.aquery_stream(
+            "Which facts?", k=3, max_sources=3, marginal_relevance=False
+        ):
+            events.append((time.perf_counter() - start, e))
+        # the quick summary is yielded before the slow ones are done
+        first_time, first = events[0]
+        assert isinstance(first, Context) and first.text.text == "Fact 0"
+        assert first_time < 0.4
+        contexts = [e for _, e in events if isinstance(e, Context)]
+        assert len(contexts) == 3
+        answer = events[-1][1]
+        assert sorted(c.text.name for c in answer.contexts) == ["Doc0", "Doc1", "Doc2"]
+
+
+class TestGatherUntil(IsolatedAsyncioTestCase):
+    async def test_early_exit(self):
+        cancelled = []
+
+        async def work(i):
+            try:
+                await asyncio.sleep(5 if i == 0 else 0.01 * i)
+            except asyncio.CancelledError:
+                cancelled.append(i)
+                raise
+            return i
+
+        # stops once 3 results are in, without waiting for the slow one
+        results = await gather_until(
+            3, [work(i) for i in range(10)], lambda r: len(r) >= 3
+        )
+        assert results == [1, 2, 3]
+        # only started ones are cancelled
+        assert sorted(cancelled) == [0, 4]
+        results = await gather_until(
+            10, [work(i) for i in range(10)], lambda r: False, timeout=0.5
+        )
+        assert sorted(results) == list(range(1, 10))
+
+
+def test_run_sync():
+    async def loop_id():
+        return id(asyncio.get_running_loop())
+
+    # calls from all threads run on the one background loop
+    with ThreadPoolExecutor(4) as executor:
+        ids = set(executor.map(lambda _: run_sync(loop_id()), range(8)))
+    assert ids == {id(get_loop())}
+
+    # even from a thread with its own loop running
+    async def nested():
+        return run_sync(loop_id())
+
+    assert asyncio.run(nested()) == id(get_loop())
+
+    # a forked child starts a loop of its own
+    def child():
+        assert run_sync(loop_id()) == id(get_loop())
+
+    process = multiprocessing.get_context("fork").Process(target=child)
+    process.start()
+    process.join(timeout=10)
+    if process.exitcode is None:
+        process.kill()
+    assert process.exitcode == 0
+
+
+class TestLimiter(IsolatedAsyncioTestCase):
+    async def test_adaptive_limiter(self):
+        limiter = AdaptiveLimiter(concurrency=4, retry_delay=0.01)
+        calls = 0
+        running = 0
+        max_running = 0
+
+        async def request():
+            nonlocal calls, running, max_running
+            calls += 1
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            if calls <= 4:
+                raise ValueError("Error code: 429 - Rate limit reached")
+            return "ok"
+
+        results = await asyncio.gather(*[limiter.call(request) for _ in range(8)])
+        # rate limited requests are retried, not dropped
+        assert results == ["ok"] * 8
+        assert max_running == 4
+        assert limiter.rate_limited == 4
+        # halved once for the whole round, then grew by about one per round of successes
+        assert limiter.successes == 8
+        assert 4 < limiter.limit < 5
+        assert limiter.active == 0
+
+        async def bad_request():
+            raise ValueError("Error code: 400 - Bad request")
+
+        with self.assertRaises(ValueError):
+            await limiter.call(bad_request)
+        assert limiter.active == 0
+
+    async def test_adaptive_limiter_cancel_woken(self):
+        limiter = AdaptiveLimiter(concurrency=1)
+        await limiter._acquire()
+        waiter = asyncio.create_task(limiter._acquire())
+        await asyncio.sleep(0)
+        # hand the slot over, and cancel the waiter once woken but before it resumes
+        limiter._release()
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        assert limiter.active == 0
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(per_minute=60)
+        assert bucket.reserve(60) == 0
+        # one per second once empty
+        assert 0.9 < bucket.reserve(1) <= 1
+        assert 1.9 < bucket.reserve(1) <= 2
+
 
 class TestDocMatch(IsolatedAsyncioTestCase):
     def test_adoc_match(self):
@@ -307,6 +652,22 @@ class TestDocMatch(IsolatedAsyncioTestCase):
         )
         docs.adoc_match("What is Frederick Bates's greatest accomplishment?")
 
+    async def test_doc_index_persisted(self):
+        tests_dir = os.path.dirname(os.path.abspath(__file__))
+        doc_path = os.path.join(tests_dir, "paper.pdf")
+        docs = Docs()
+        docs.add(doc_path, "Wellawatte et al, XAI Review, 2023", dockey="a")
+        docs.add(doc_path, "Smith et al, Another Review, 2021", dockey="b")
+        # built when documents are added, not when querying
+        assert docs.doc_index.index.ntotal == 2
+        docs.delete(dockey="a")
+        docs2 = pickle.loads(pickle.dumps(docs))
+        assert docs2.doc_index is not None
+        assert await docs2.adoc_match("Smith review") == {"b"}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            docs.save(tmpdir)
+            assert await Docs.load(tmpdir).adoc_match("Smith review") == {"b"}
+
 
 def test_docs_pickle():
     doc_path = "example.html"
@@ -347,6 +708,146 @@ def test_docs_pickle():
     docs.query("What date is bring your dog to work in the US?")
 
 
+def test_docs_save_load():
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    docs = Docs()
+    docs.add(doc_path, "Wellawatte et al, XAI Review, 2023", dockey="a")
+    question = "Are counterfactuals actionable?"
+    answer1 = docs.get_evidence(
+        Answer(question=question), k=5, max_sources=5, disable_summarization=True
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        docs.save(tmpdir)
+        docs2 = Docs.load(tmpdir)
+        assert len(docs2.texts) == len(docs.texts)
+        assert docs2.docs == docs.docs
+        answer2 = docs2.get_evidence(
+            Answer(question=question), k=5, max_sources=5, disable_summarization=True
+        )
+        assert [c.text.name for c in answer1.contexts] == [
+            c.text.name for c in answer2.contexts
+        ]
+        # loaded collections can still be changed and saved again
+        docs2.add(doc_path, "Wellawatte et al, XAI Review, 2023", dockey="b")
+        docs2.delete(dockey="a")
+        docs2.save(tmpdir)
+        docs3 = Docs.load(tmpdir)
+        assert set(docs3.docs) == {"b"}
+        assert [t.text for t in docs3.texts] == [t.text for t in docs.texts]
+
+
+def test_docs_save_load_change():
+    def add(docs, i):
+        doc = Doc(docname=f"Doc{i}", citation=f"Author, Title {i}, 2023", dockey=i)
+        texts = [
+            Text(text=f"Text {j} of document {i}", name=f"Doc{i} chunk {j}", doc=doc)
+            for j in range(5)
+        ]
+        docs.add_texts(texts, doc)
+
+    docs = Docs(embeddings=FakeEmbeddings(size=16), embedding_cache=None)
+    add(docs, 0)
+    add(docs, 1)
+    docs._build_texts_index()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        docs.save(tmpdir)
+        # the memory-mapped index is never written to
+        docs2 = Docs.load(tmpdir)
+        assert docs2.texts_index.mapped
+        add(docs2, 2)
+        assert docs2.texts_index.index.ntotal == 15
+        docs2.delete(dockey=0)
+        docs2.compact()
+        assert docs2.texts_index.index.ntotal == 10
+        docs3 = Docs.load(tmpdir)
+        docs3.delete(dockey=1)
+        docs3.compact()
+        assert docs3.texts_index.index.ntotal == 5
+        assert set(docs3.docs) == {0}
+
+
+def test_add_texts_other_doc():
+    docs = Docs(embeddings=FakeEmbeddings(size=16), embedding_cache=None)
+    other = Doc(docname="Tmp", citation="Tmp, 2023", dockey="tmp")
+    texts = [Text(text=f"Fact {i}", name=f"Tmp chunk {i}", doc=other) for i in range(3)]
+    doc = Doc(docname="Real", citation="Author, Title, 2023", dockey="real")
+    # the texts become the document's they are added with
+    assert docs.add_texts(texts, doc)
+    assert docs.text_id_ranges["real"] == (0, 3)
+    assert all(t.doc is doc for t in docs.texts)
+    answer = docs.get_evidence(
+        Answer(question="Which facts?"),
+        k=3,
+        max_sources=3,
+        marginal_relevance=False,
+        disable_summarization=True,
+    )
+    assert sorted(c.text.text for c in answer.contexts) == [t.text for t in texts]
+
+
+def test_docs_save_caches():
+    memory = ConversationBufferMemory(
+        memory_key="memory", input_key="Question", output_key="Answer"
+    )
+    docs = Docs(
+        embeddings=FakeEmbeddings(size=16),
+        embedding_cache=None,
+        summary_cache=MemorySummaryCache(max_size=5),
+        answer_cache=AnswerCache(threshold=0.9),
+        memory=True,
+    )
+    docs.memory_model = memory
+    doc = Doc(docname="Doc", citation="Author, Title, 2023", dockey="doc")
+    docs.add_texts([Text(text="Some text", name="Doc chunk 1", doc=doc)], doc)
+    docs._embed_query("What is it?")
+    docs.summary_cache.set("key", "A summary")
+    docs.answer_cache.set([1.0, 0.0], "key", docs.generation, "An answer")
+    memory.save_context({"Question": "What is it?"}, {"Answer": "A text."})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        docs.save(tmpdir)
+        loaded = Docs.load(tmpdir)
+    # caches and the conversation come back empty, but set up the same
+    model = get_embedding_name(docs.embeddings)
+    assert loaded.query_embedding_cache.get(model, "What is it?") is None
+    assert loaded.summary_cache.get("key") is None
+    assert loaded.summary_cache.max_size == 5
+    assert len(loaded.answer_cache) == 0
+    assert loaded.answer_cache.threshold == 0.9
+    assert loaded.memory_model.load_memory_variables({})["memory"] == ""
+    assert loaded.memory_model.memory_key == "memory"
+    # and the collection's own are kept
+    assert docs.query_embedding_cache.get(model, "What is it?") is not None
+    assert docs.summary_cache.get("key") == "A summary"
+    assert len(docs.answer_cache) == 1
+    assert "A text." in docs.memory_model.load_memory_variables({})["memory"]
+
+
+def test_docs_pickle_unchanged(tmp_path):
+    docs = Docs(
+        embeddings=FakeEmbeddings(size=16),
+        embedding_cache=None,
+        compact_threshold=0.9,
+        index_path=tmp_path / "index",
+    )
+    for name in ["a", "b"]:
+        doc = Doc(docname=name, citation=f"Author, {name}, 2023", dockey=name)
+        texts = [Text(text=f"Text {i}", name=f"{name} {i}", doc=doc) for i in range(3)]
+        docs.add_texts(texts, doc)
+    docs._build_texts_index()
+    docs.delete(dockey="a")
+    texts_index = docs.texts_index
+    assert len(texts_index.deleted) == 3
+    loaded = pickle.loads(pickle.dumps(docs))
+    # what is pickled is compacted, but the collection is not changed
+    assert loaded.texts_index.index.ntotal == 3
+    assert len(loaded.embedding_store) == 3
+    assert docs.texts_index is texts_index
+    assert len(texts_index.deleted) == 3
+    assert len(docs.embedding_store) == 6
+    assert [t.row for t in docs.texts] == [3, 4, 5]
+
+
 def test_docs_pickle_no_faiss():
     doc_path = "example.html"
     with open(doc_path, "w", encoding="utf-8") as f:
@@ -465,6 +966,20 @@ def test_fileio_reader_txt():
     assert "Virginia" in answer.answer
 
 
+def test_add_buffer():
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    with open(doc_path, "rb") as f:
+        data = f.read()
+    docs = Docs(parse_cache=None)
+    docs.add_buffer(memoryview(data), "Wellawatte et al, XAI Review, 2023")
+    # same dockey as adding from the path
+    assert md5sum(doc_path) in docs.docs
+    assert docs.add(doc_path, "Wellawatte et al, XAI Review, 2023") is None
+    splits = read_doc(doc_path, Doc(docname="Wellawatte2023", citation="", dockey=1))
+    assert [t.text for t in docs.texts] == [t.text for t in splits]
+
+
 def test_pdf_pypdf_reader():
     tests_dir = os.path.dirname(os.path.abspath(__file__))
     doc_path = os.path.join(tests_dir, "paper.pdf")
@@ -488,6 +1003,199 @@ def test_pdf_pypdf_reader():
     )
 
 
+def test_iter_doc():
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    doc = Doc(docname="foo", citation="Foo et al, 2002", dockey="1")
+    for force_pypdf in [True, False]:
+        chunks = iter_doc(doc_path, doc, chunk_chars=1000, force_pypdf=force_pypdf)
+        first = next(chunks)
+        assert first.name == "foo pages 1-1"
+        splits = read_doc(doc_path, doc, chunk_chars=1000, force_pypdf=force_pypdf)
+        assert [first] + list(chunks) == splits
+
+
+def test_parse_cache():
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = ParseCache(tmpdir)
+        doc = Doc(docname="foo", citation="Foo et al, 2002", dockey="1")
+        splits1 = read_doc(doc_path, doc, cache=cache)
+        assert len(os.listdir(tmpdir)) == 1
+        doc = Doc(docname="bar", citation="Bar et al, 2002", dockey="1")
+        splits2 = read_doc(doc_path, doc, cache=cache)
+        assert [s.text for s in splits1] == [s.text for s in splits2]
+        assert splits2[0].name == "bar pages 1-2"
+        # different chunking is a different entry
+        read_doc(doc_path, doc, chunk_chars=1000, cache=cache)
+        assert len(os.listdir(tmpdir)) == 2
+        # evict everything
+        cache.max_size = 0
+        cache.evict()
+        assert len(os.listdir(tmpdir)) == 0
+
+
+def test_embedding_cache():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = EmbeddingCache(os.path.join(tmpdir, "embeddings.sqlite"), max_entries=2)
+        cache.set_many("model", ["a", "b"], [[1.0, 2.0], [3.0, 4.0]])
+        assert cache.get_many("model", ["a", "c"]) == [[1.0, 2.0], None]
+        assert cache.get_many("other-model", ["a"]) == [None]
+        assert cache.hits == 1
+        assert cache.misses == 2
+        # least recently used (b) is evicted
+        cache.set_many("model", ["c"], [[5.0, 6.0]])
+        assert cache.get_many("model", ["a", "b", "c"]) == [
+            [1.0, 2.0],
+            None,
+            [5.0, 6.0],
+        ]
+        # survives pickling (e.g. with Docs)
+        cache2 = pickle.loads(pickle.dumps(cache))
+        assert cache2.get_many("model", ["c"]) == [[5.0, 6.0]]
+
+        # bounded by the size of the vectors (8 bytes each here) instead
+        cache = EmbeddingCache(os.path.join(tmpdir, "sized.sqlite"), max_size=16)
+        cache.set_many("model", ["a", "b"], [[1.0, 2.0], [3.0, 4.0]])
+        assert cache.size == 16
+        # replacing a vector does not count it twice
+        cache.set_many("model", ["a"], [[1.0, 2.0]])
+        assert cache.size == 16
+        cache.set_many("model", ["c", "d"], [[5.0, 6.0], [7.0, 8.0]])
+        assert cache.get_many("model", ["a", "b", "c", "d"]) == [
+            None,
+            None,
+            [5.0, 6.0],
+            [7.0, 8.0],
+        ]
+        assert cache.size == 16
+
+
+def test_query_embedding_cache():
+    cache = QueryEmbeddingCache(max_size=2, ttl=None)
+    cache.set("model", "a", [1.0])
+    cache.set("model", "b", [2.0])
+    assert cache.get("model", "a") == [1.0]
+    # least recently used (b) is evicted
+    cache.set("model", "c", [3.0])
+    assert cache.get("model", "b") is None
+    assert cache.get("other-model", "a") is None
+    cache.ttl = 0
+    assert cache.get("model", "a") is None
+
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    docs = Docs()
+    docs.add(doc_path, "Wellawatte et al, XAI Review, 2023", dockey="a")
+    docs.query("Are counterfactuals actionable?", key_filter=True)
+    # embedded once for both the document and the chunk search
+    assert docs.query_embedding_cache.misses == 1
+    docs.query("Are counterfactuals actionable?", key_filter=True)
+    assert docs.query_embedding_cache.misses == 1
+
+
+def test_summary_cache():
+    key = MemorySummaryCache.make_key(question="q", text="t")
+    assert key == MemorySummaryCache.make_key(text="t", question="q")
+    assert key != MemorySummaryCache.make_key(question="q", text="t2")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for cache in [
+            MemorySummaryCache(max_size=2),
+            SQLiteSummaryCache(os.path.join(tmpdir, "summaries.sqlite"), max_entries=2),
+        ]:
+            cache.set("a", "summary a")
+            cache.set("b", "summary b")
+            assert cache.get("a") == "summary a"
+            # least recently used (b) is evicted
+            cache.set("c", "summary c")
+            assert cache.get("b") is None
+            assert cache.hits == 1 and cache.misses == 1
+            assert cache.hit_rate == 0.5
+            assert pickle.loads(pickle.dumps(cache)).get("c") == "summary c"
+
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    docs = Docs()
+    docs.add(doc_path, "Wellawatte et al, XAI Review, 2023")
+    docs.get_evidence(Answer(question="Are counterfactuals actionable?"), k=3)
+    assert docs.summary_cache.misses == 3
+    docs.get_evidence(Answer(question="Are counterfactuals actionable?"), k=3)
+    assert docs.summary_cache.hits == 3
+
+
+def test_summary_cache_abstract():
+    class PartialCache(SummaryCache):
+        def _get(self, key):
+            return None
+
+    # subclasses must implement _get, set and clear
+    with pytest.raises(TypeError):
+        SummaryCache()
+    with pytest.raises(TypeError):
+        PartialCache()
+
+
+def test_answer_cache():
+    cache = AnswerCache(threshold=0.9, max_size=2)
+    cache.set([1.0, 0.0], "settings", 0, "answer")
+    assert cache.get([0.99, 0.05], "settings", 0) == "answer"
+    assert cache.get([0.0, 1.0], "settings", 0) is None
+    assert cache.get([1.0, 0.0], "other settings", 0) is None
+    # documents changed since
+    assert cache.get([1.0, 0.0], "settings", 1) is None
+    assert len(cache) == 0
+
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    docs = Docs(answer_cache=AnswerCache())
+    docs.add(doc_path, "Wellawatte et al, XAI Review, 2023", dockey="a")
+    generation = docs.generation
+    answer1 = docs.query("Are counterfactuals actionable?")
+    answer2 = docs.query("Are counterfactuals actionable?")
+    assert docs.answer_cache.hits == 1
+    assert answer1.answer == answer2.answer
+    docs.delete(dockey="a")
+    assert docs.generation > generation
+
+
+def test_query_many():
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    docs = Docs()
+    docs.add(doc_path, "Wellawatte et al, XAI Review, 2023")
+    docs._build_texts_index()
+    questions = ["Are counterfactuals actionable?", "What is XAI?"]
+    embeddings = run_sync(docs._aembed_queries(questions))
+    for embedding, matches in zip(
+        embeddings, docs.texts_index.search_many_by_vectors(embeddings, k=3)
+    ):
+        expected = docs.texts_index.similarity_search_by_vector(embedding, k=3)
+        assert matches == expected
+    answers = docs.query_many(questions + questions[:1], k=5, max_sources=2)
+    assert [a.question for a in answers] == questions + questions[:1]
+    assert answers[2].answer == answers[0].answer
+    assert answers[2] is not answers[0]
+
+
+def test_embed_queries():
+    class QueryEmbeddings(FakeEmbeddings):
+        """Embeds questions differently from documents."""
+
+        def embed_query(self, text: str) -> List[float]:
+            return [float(len(text))] * self.size
+
+    embeddings = QueryEmbeddings(size=4)
+    docs = Docs(embeddings=embeddings)
+    questions = ["What is XAI?", "Are counterfactuals actionable?"]
+    expected = [embeddings.embed_query(q) for q in questions]
+    assert run_sync(docs._aembed_queries(questions)) == expected
+    # shared with single questions
+    assert docs.query_embedding_cache.hits == 0
+    assert docs._embed_query(questions[0]) == expected[0]
+    assert docs.query_embedding_cache.hits == 1
+
+
 def test_prompt_length():
     doc_path = "example.txt"
     with open(doc_path, "w", encoding="utf-8") as f:
@@ -522,6 +1230,18 @@ def test_citation():
     )
 
 
+def test_citation_single_parse():
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    model = FakeListLLM(responses=["Wellawatte et al, XAI Review, 2023"])
+    docs = Docs(llm=model, parse_cache=None)
+    assert docs.add(doc_path) == "Wellawatte2023"
+    assert docs.texts[0].name == "Wellawatte2023 pages 1-2"
+    for t in docs.texts:
+        assert t.doc == docs.docs[t.doc.dockey]
+        assert t.doc.citation == "Wellawatte et al, XAI Review, 2023"
+
+
 def test_dockey_filter():
     """Test that we can filter evidence with dockeys"""
     doc_path = "example2.txt"
@@ -540,6 +1260,26 @@ def test_dockey_filter():
     docs.get_evidence(answer)
 
 
+def test_dockey_filter_prefiltered():
+    """Test that filtered search returns k results without rebuilding the index"""
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    docs = Docs(jit_texts_index=True)
+    docs.add(doc_path, "Wellawatte et al, XAI Review, 2023", dockey="a")
+    docs.add(doc_path, "Wellawatte et al, XAI Review, 2023", dockey="b")
+    for key in ["a", "b"]:
+        answer = docs.get_evidence(
+            Answer(question="Are counterfactuals actionable?", dockey_filter={key}),
+            k=5,
+            max_sources=5,
+            disable_summarization=True,
+        )
+        assert len(answer.contexts) == 5
+        assert all(c.text.doc.dockey == key for c in answer.contexts)
+    # one index over both documents
+    assert docs.texts_index.index.ntotal == len(docs.texts)
+
+
 def test_dockey_delete():
     """Test that we can filter evidence with dockeys"""
     doc_path = "example2.txt"
@@ -569,6 +1309,167 @@ def test_dockey_delete():
     assert len(keys) == 1
 
 
+def test_delete_compact():
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    docs = Docs(compact_threshold=0.9)
+    docs.add(doc_path, "Wellawatte et al, XAI Review, 2023", dockey="a")
+    docs.add(doc_path, "Wellawatte et al, XAI Review, 2023", dockey="b")
+    docs._build_texts_index()
+    n = docs.texts_index.index.ntotal
+    docs.delete(dockey="a")
+    assert len(docs.texts) == n // 2
+    assert docs.docnames == {"Wellawatte2023a"}
+    # below threshold, so only tombstoned
+    assert len(docs.texts_index.deleted) == n // 2
+    answer = docs.get_evidence(
+        Answer(question="Are counterfactuals actionable?"),
+        k=n,
+        max_sources=n,
+        disable_summarization=True,
+    )
+    assert len(answer.contexts) == n // 2
+    assert all(c.text.doc.dockey == "b" for c in answer.contexts)
+    docs.compact()
+    assert docs.texts_index.index.ntotal == n // 2
+    assert len(docs.texts_index.deleted) == 0
+
+
+def test_query_during_add_many():
+    embedding = threading.Event()
+
+    class SlowEmbeddings(FakeEmbeddings):
+        def embed_documents(self, texts):
+            embedding.set()
+            time.sleep(2)
+            return super().embed_documents(texts)
+
+    docs = Docs(embeddings=SlowEmbeddings(size=16), embedding_cache=None)
+    doc = Doc(docname="Doc0", citation="Author, Title, 2023", dockey="doc0")
+    texts = [
+        Text(text=f"Text {j}", name=f"Doc0 chunk {j}", doc=doc, embeddings=[0.1] * 16)
+        for j in range(5)
+    ]
+    docs.add_texts(texts, doc)
+    embedding.clear()
+    doc_path = "example.txt"
+    with open(doc_path, "w", encoding="utf-8") as f:
+        f.write("Some text about bananas, which are yellow. " * 20)
+    with ThreadPoolExecutor(1) as executor:
+        adding = executor.submit(
+            docs.add_many, [Path(doc_path)], citations=["Author, Bananas, 2023"]
+        )
+        while not embedding.is_set():
+            assert not adding.done(), adding.result()
+            time.sleep(0.01)
+        # add_many is embedding on another thread, which does not hold up queries
+        start = time.perf_counter()
+        answer = docs.get_evidence(
+            Answer(question="What are texts?"), k=3, disable_summarization=True
+        )
+        assert time.perf_counter() - start < 1
+        assert len(answer.contexts) > 0
+        assert not adding.done()
+        adding.result()
+    os.remove(doc_path)
+    assert len(docs.docs) == 2
+
+
+def test_idmap_faiss_segments():
+    rng = np.random.default_rng(0)
+    vectors = rng.random((100, 8), dtype=np.float32)
+    embeddings = FakeEmbeddings(size=8)
+    store = IDMapFAISS.from_vectors(["0"], vectors[:1], embeddings, ids=[0])
+    stores = [store]
+    for i in range(1, 100):
+        # each copy is changed while the ones before may still be searched
+        store = store.copy()
+        store.add_vectors([str(i)], vectors[i : i + 1], ids=[i])
+        stores.append(store)
+    for i, s in enumerate(stores):
+        assert s.ntotal == i + 1
+    # segments shrink geometrically, and the biggest are shared
+    assert len(store.segments) <= 7
+    assert stores[-2].segments[0] is store.segments[0]
+    query = rng.random(8, dtype=np.float32)
+    found = store.similarity_search_by_vector(query.tolist(), k=5)
+    expected = np.argsort(((vectors - query) ** 2).sum(axis=1))[:5]
+    assert [d.metadata["id"] for d in found] == expected.tolist()
+    found = stores[9].similarity_search_by_vector(query.tolist(), k=3)
+    expected = np.argsort(((vectors[:10] - query) ** 2).sum(axis=1))[:3]
+    assert [d.metadata["id"] for d in found] == expected.tolist()
+    compacted = store.copy()
+    compacted.delete(list(range(50)))
+    compacted.compact()
+    assert compacted.ntotal == 50 and len(compacted.segments) == 1
+    assert store.ntotal == 100
+    assert store.get_by_ids([0]) and not compacted.get_by_ids([0])
+
+
+def test_snapshot():
+    docs = Docs(embeddings=FakeEmbeddings(size=16), embedding_cache=None)
+
+    def add(i):
+        doc = Doc(docname=f"Doc{i}", citation=f"Author, Title {i}, 2023", dockey=i)
+        texts = [
+            Text(text=f"Text {j} of document {i}", name=f"Doc{i} chunk {j}", doc=doc)
+            for j in range(5)
+        ]
+        docs.add_texts(texts, doc)
+
+    add(0)
+    add(1)
+    docs._build_texts_index()
+    view = docs.snapshot()
+    add(2)
+    docs.delete(dockey=0)
+    docs.compact()
+    # the snapshot is as it was
+    assert set(view.docs) == {0, 1}
+    assert len(view.texts) == 10
+    assert view.texts_index.index.ntotal == 10
+    assert len(view.texts_index.deleted) == 0
+    assert set(docs.docs) == {1, 2}
+    assert docs.texts_index.index.ntotal == 10
+
+    def search(_):
+        view = docs.snapshot()
+        matches = view.texts_index.similarity_search_by_vector([0.1] * 16, k=3)
+        return all(m.metadata["doc"]["dockey"] in view.docs for m in matches)
+
+    # queries while documents are added and deleted
+    with ThreadPoolExecutor(4) as executor:
+        results = executor.map(search, range(200))
+        for i in range(3, 13):
+            add(i)
+            docs.delete(dockey=i - 1)
+        assert all(results)
+    assert set(docs.docs) == {1, 12}
+
+
+def test_embedding_store():
+    store = EmbeddingStore("float16")
+    assert store.append([[1.0, 2.0], [3.0, 4.0]]) == range(0, 2)
+    assert store.append(np.ones((3, 2))) == range(2, 5)
+    assert store.matrix.shape == (5, 2) and store.matrix.dtype == np.float16
+    store.compact([4, 1])
+    assert np.allclose(store.matrix, [[1.0, 1.0], [3.0, 4.0]])
+    assert pickle.loads(pickle.dumps(store)).matrix.dtype == np.float16
+
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    docs = Docs()
+    docs.add(doc_path, "Wellawatte et al, XAI Review, 2023", dockey="a")
+    docs.add(doc_path, "Wellawatte et al, XAI Review, 2023", dockey="b")
+    assert len(docs.embedding_store) == len(docs.texts)
+    assert all(t.embeddings is None for t in docs.texts)
+    docs.delete(dockey="a")
+    docs.compact()
+    assert [t.row for t in docs.texts] == list(range(len(docs.texts)))
+    docs2 = pickle.loads(pickle.dumps(docs))
+    assert np.array_equal(docs2.embedding_store.matrix, docs.embedding_store.matrix)
+
+
 def test_query_filter():
     """Test that we can filter evidence with in query"""
     doc_path = "example2.txt"
@@ -671,7 +1572,11 @@ def test_pre_prompt():
         r = requests.get("https://en.wikipedia.org/wiki/Frederick_Bates_(politician)")
         f.write(r.text)
     docs.add(doc_path, "WikiMedia Foundation, 2023, Accessed now")
-    docs.query("What country is Bates from?")
+    answer = docs.query("What country is Bates from?")
+    assert "Extra background information" in answer.context
+    # the pre prompt runs while evidence is gathered
+    timings = answer.timings
+    assert timings["total"] < timings["pre"] + timings["evidence"] + timings["answer"]
 
 
 def test_post_prompt():
@@ -702,6 +1607,41 @@ def test_post_prompt():
     docs.query("What country is Bates from?")
 
 
+def test_make_chain_cache():
+    llm = FakeListLLM(responses=["answer"])
+    prompt = PromptTemplate(input_variables=["question"], template="Q: {question}")
+    chain = make_chain(prompt, llm)
+    assert make_chain(prompt, llm) is chain
+    assert make_chain(prompt, llm, skip_system=True) is not chain
+    memory = ConversationBufferMemory(
+        memory_key="memory", input_key="Question", output_key="Answer"
+    )
+    # no memory yet, so the prompt is unchanged
+    assert make_chain(prompt, llm, memory=memory) is chain
+    memory.save_context({"Question": "What is {x}?"}, {"Answer": "It is {y}."})
+    memory_chain = make_chain(prompt, llm, memory=memory)
+    assert memory_chain is not chain
+    assert make_chain(prompt, llm, memory=memory) is memory_chain
+    # memory is filled in on each call, so it can change
+    inputs = memory_chain.prep_inputs({"question": "And z?"})
+    assert "It is {y}." in memory_chain.prompt.format(**inputs)
+    memory.save_context({"Question": "And z?"}, {"Answer": "It is w."})
+    inputs = memory_chain.prep_inputs({"question": "And v?"})
+    assert "It is w." in memory_chain.prompt.format(**inputs)
+    assert memory_chain.run(question="And v?") == "answer"
+    # the post chain is given every answer field, including an empty memory
+    post = PromptTemplate(
+        input_variables=["question", "answer", "memory"],
+        template="Memory: {memory}\nQ: {question}\nA: {answer}",
+    )
+    post_chain = make_chain(post, llm, memory=memory)
+    answer = Answer(question="And v?", answer="It is u.")
+    assert answer.memory is None
+    inputs = post_chain.prep_inputs(answer.dict())
+    prompts, _ = post_chain.prep_prompts([inputs])
+    assert "It is w." in prompts[0].to_string()
+
+
 def test_memory():
     # Not sure why, but gpt-3.5 cannot do this anymore.
     docs = Docs(memory=True, k=3, max_sources=1, llm="gpt-4", key_filter=False)
@@ -748,7 +1688,9 @@ def test_add_texts():
 
     for t1, t2 in zip(docs2.texts, docs.texts):
         assert t1.text == t2.text
-        assert np.allclose(t1.embeddings, t2.embeddings, atol=1e-3)
+        assert np.allclose(
+            docs2.embedding_store[t1.row], docs.embedding_store[t2.row], atol=1e-3
+        )
 
     docs2._build_texts_index()
     # now do it again to test after text index is already built
@@ -802,3 +1744,29 @@ def test_external_texts_index():
 
     answer = docs.query(query="What is the date of flag day?", key_filter=True)
     assert "February 15" in answer.answer
+
+
+def test_add_many():
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    doc_path = os.path.join(tests_dir, "paper.pdf")
+    doc_path2 = "example.txt"
+    with open(doc_path2, "w", encoding="utf-8") as f:
+        # get wiki page about politician
+        r = requests.get("https://en.wikipedia.org/wiki/Frederick_Bates_(politician)")
+        f.write(r.text)
+    docs = Docs()
+    results = docs.add_many(
+        [doc_path, doc_path2, "missing.pdf"],
+        citations=[
+            "Wellawatte et al, XAI Review, 2023",
+            "WikiMedia Foundation, 2023, Accessed now",
+            None,
+        ],
+    )
+    assert results[doc_path] == "Wellawatte2023"
+    assert results[doc_path2] == "Wiki2023"
+    assert isinstance(results["missing.pdf"], Exception)
+    assert len(docs.docs) == 2
+    # already added
+    assert docs.add_many([doc_path]) == {doc_path: None}
+    os.remove(doc_path2)
@@ -0,0 +1,578 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .paths import UNBOWED_AI_PATH
+
+# bump this if the chunkers change, so stale parses are not reused
+PARSE_CACHE_VERSION = 1
+
+
+def make_cache_key(**parts: Any) -> str:
+    """Hash named parts (anything JSON serializable) into a cache key."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ParseCache:
+    """A content-addressed on-disk cache of parsed document chunks.
+
+    Entries are keyed by file hash, reader backend, chunk size and overlap.
+    Each entry is one zlib-compressed JSON file holding the chunk texts and
+    their names (without the docname, which is applied on load). When the
+    cache grows past ``max_size`` bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self,
+        path: Path = UNBOWED_AI_PATH / "parse_cache",
+        max_size: int = 512 * 1024**2,
+    ):
+        self.path = Path(path)
+        self.max_size = max_size
+
+    @staticmethod
+    def make_key(file_hash: str, backend: str, chunk_chars: int, overlap: int) -> str:
+        return f"{file_hash}-{backend}-{chunk_chars}-{overlap}-v{PARSE_CACHE_VERSION}"
+
+    def _entry(self, key: str) -> Path:
+        return self.path / f"{key}.json.z"
+
+    def get(self, key: str) -> Optional[List[Tuple[str, str]]]:
+        """Return the cached (name suffix, text) pairs, or None on a miss."""
+        entry = self._entry(key)
+        try:
+            with open(entry, "rb") as f:
+                data = json.loads(zlib.decompress(f.read()))
+            # mark as recently used
+            os.utime(entry)
+        except (OSError, ValueError, zlib.error):
+            return None
+        return list(zip(data["names"], data["texts"]))
+
+    def set(self, key: str, chunks: List[Tuple[str, str]]) -> None:
+        """Store (name suffix, text) pairs and evict old entries if over size."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        data = {"names": [n for n, _ in chunks], "texts": [t for _, t in chunks]}
+        blob = zlib.compress(json.dumps(data).encode("utf-8"))
+        # write then rename so concurrent readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(blob)
+        os.replace(tmp, self._entry(key))
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the cache fits in max_size."""
+        entries = []
+        total = 0
+        for e in os.scandir(self.path):
+            if e.name.endswith(".json.z"):
+                stat = e.stat()
+                entries.append((stat.st_mtime, stat.st_size, e.path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        if not self.path.exists():
+            return
+        for e in os.scandir(self.path):
+            if e.name.endswith(".json.z"):
+                os.remove(e.path)
+
+
+class EmbeddingCache:
+    """A persistent SQLite cache of text embeddings.
+
+    Vectors are stored as float32 blobs keyed by (embedding model, sha256 of
+    the text), so identical chunks are embedded only once across rebuilds,
+    re-ingests and Docs instances. When the vectors take up more than
+    ``max_size`` bytes (512MB, about 85k OpenAI embeddings, by default; the
+    file is somewhat larger) or there are more than ``max_entries`` of them,
+    the least recently used ones are evicted.
+    """
+
+    def __init__(
+        self,
+        path: Path = UNBOWED_AI_PATH / "embedding_cache.sqlite",
+        max_size: Optional[int] = 512 * 1024**2,
+        max_entries: Optional[int] = None,
+    ):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # connections and locks cannot be pickled (or deep copied)
+        state["_conn"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT, text_hash TEXT, vector BLOB, last_used REAL, "
+                "PRIMARY KEY (model, text_hash))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used "
+                "ON embeddings (last_used)"
+            )
+            # the total size of the vectors is kept up to date by triggers, so
+            # it is not summed on every write (or missed from other processes)
+            # and replaced rows are subtracted too (see recursive_triggers)
+            self._conn.execute("PRAGMA recursive_triggers = ON")
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS size (bytes INTEGER)")
+            self._conn.execute(
+                "INSERT INTO size SELECT COALESCE(SUM(LENGTH(vector)), 0) "
+                "FROM embeddings WHERE NOT EXISTS (SELECT * FROM size)"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS embeddings_insert AFTER INSERT ON "
+                "embeddings BEGIN UPDATE size SET bytes = bytes + LENGTH(NEW.vector); END"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS embeddings_delete AFTER DELETE ON "
+                "embeddings BEGIN UPDATE size SET bytes = bytes - LENGTH(OLD.vector); END"
+            )
+            self._conn.commit()
+        return self._conn
+
+    @property
+    def size(self) -> int:
+        """The total size of the cached vectors, in bytes."""
+        with self._lock:
+            return self.conn.execute("SELECT bytes FROM size").fetchone()[0]
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """Return the cached embedding of each text, or None where it is missing."""
+        hashes = [self.hash_text(t) for t in texts]
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            # stay under sqlite's limit on query parameters
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i : i + 500]
+                rows = self.conn.execute(
+                    "SELECT text_hash, vector FROM embeddings WHERE model = ? "
+                    f"AND text_hash IN ({','.join('?' * len(batch))})",
+                    [model, *batch],
+                ).fetchall()
+                for h, v in rows:
+                    found[h] = np.frombuffer(v, dtype=np.float32).tolist()
+            if found:
+                self.conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(time.time(), model, h) for h in found],
+                )
+                self.conn.commit()
+        result = [found.get(h) for h in hashes]
+        hits = sum(r is not None for r in result)
+        self.hits += hits
+        self.misses += len(result) - hits
+        return result
+
+    def set_many(
+        self, model: str, texts: List[str], embeddings: List[List[float]]
+    ) -> None:
+        now = time.time()
+        rows = [
+            (model, self.hash_text(t), np.asarray(e, dtype=np.float32).tobytes(), now)
+            for t, e in zip(texts, embeddings)
+        ]
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows
+            )
+            if self.max_entries is not None:
+                (count,) = self.conn.execute(
+                    "SELECT COUNT(*) FROM embeddings"
+                ).fetchone()
+                if count > self.max_entries:
+                    self.conn.execute(
+                        "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM "
+                        "embeddings ORDER BY last_used LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+            if self.max_size is not None:
+                (size,) = self.conn.execute("SELECT bytes FROM size").fetchone()
+                excess = size - self.max_size
+                evicted = []
+                # only as many of the oldest rows as need to go are read
+                rows = self.conn.execute(
+                    "SELECT rowid, LENGTH(vector) FROM embeddings ORDER BY last_used"
+                )
+                while excess > 0:
+                    row = rows.fetchone()
+                    if row is None:
+                        break
+                    evicted.append(row[0])
+                    excess -= row[1]
+                rows.close()
+                for i in range(0, len(evicted), 500):
+                    batch = evicted[i : i + 500]
+                    self.conn.execute(
+                        f"DELETE FROM embeddings WHERE rowid IN ({','.join('?' * len(batch))})",
+                        batch,
+                    )
+            self.conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.conn.execute("DELETE FROM embeddings")
+            self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+
+class QueryEmbeddingCache:
+    """An in-memory LRU cache of query embeddings.
+
+    Entries are keyed by (embedding model, query) and expire ``ttl`` seconds
+    after they were embedded (never if None). When there are more than
+    ``max_size`` entries, the least recently used ones are evicted.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, List[float]]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # locks cannot be pickled (or deep copied)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, model: str, query: str) -> Optional[List[float]]:
+        key = (model, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (
+                self.ttl is None or time.time() - entry[0] < self.ttl
+            ):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, model: str, query: str, embedding: List[float]) -> None:
+        key = (model, query)
+        with self._lock:
+            self._entries[key] = (time.time(), embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def empty(self) -> "QueryEmbeddingCache":
+        """Return a new, empty cache with the same settings."""
+        return type(self)(max_size=self.max_size, ttl=self.ttl)
+
+
+class SummaryCache(ABC):
+    """Base class of caches of chunk summaries made when gathering evidence.
+
+    Subclasses implement ``_get``, ``set`` and ``clear``. Keys are made with
+    ``make_key`` from everything that goes into a summary.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    make_key = staticmethod(make_cache_key)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached summary, or None on a miss."""
+        summary = self._get(key)
+        if summary is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return summary
+
+    @abstractmethod
+    def _get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, summary: str) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+
+class MemorySummaryCache(SummaryCache):
+    """An in-memory LRU cache of up to ``max_size`` summaries."""
+
+    def __init__(self, max_size: int = 10_000):
+        super().__init__()
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # locks cannot be pickled (or deep copied)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            summary = self._entries.get(key)
+            if summary is not None:
+                self._entries.move_to_end(key)
+            return summary
+
+    def set(self, key: str, summary: str) -> None:
+        with self._lock:
+            self._entries[key] = summary
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def empty(self) -> "MemorySummaryCache":
+        """Return a new, empty cache with the same settings."""
+        return type(self)(max_size=self.max_size)
+
+
+class SQLiteSummaryCache(SummaryCache):
+    """A persistent SQLite cache of summaries, shared across processes and restarts.
+
+    When there are more than ``max_entries`` summaries, the least recently
+    used ones are evicted.
+    """
+
+    def __init__(
+        self,
+        path: Path = UNBOWED_AI_PATH / "summary_cache.sqlite",
+        max_entries: int = 100_000,
+    ):
+        super().__init__()
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # connections and locks cannot be pickled (or deep copied)
+        state["_conn"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                "key TEXT PRIMARY KEY, summary TEXT, last_used REAL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS summaries_last_used "
+                "ON summaries (last_used)"
+            )
+        return self._conn
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT summary FROM summaries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE summaries SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self.conn.commit()
+            return row[0]
+
+    def set(self, key: str, summary: str) -> None:
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)",
+                (key, summary, time.time()),
+            )
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM summaries").fetchone()
+            if count > self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM summaries WHERE rowid IN (SELECT rowid FROM "
+                    "summaries ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self.conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.conn.execute("DELETE FROM summaries")
+            self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+
+class AnswerCache:
+    """An in-memory semantic cache of answers, looked up by question embedding.
+
+    An answer is returned for a question whose embedding has cosine
+    similarity of at least ``threshold`` with that of the question it answered,
+    if it was asked with the same settings (``key``) and generation of the
+    documents. Entries from other generations are dropped as they can be out
+    of date. Past ``max_size`` entries, the oldest are evicted.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_size: int = 1000):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # unit question embeddings, one row per entry
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        self._entries: List[Tuple[str, int, Any]] = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # locks cannot be pickled (or deep copied)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _unit(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _keep(self, keep: List[int]) -> None:
+        self._vectors = self._vectors[keep]
+        self._entries = [self._entries[i] for i in keep]
+
+    def get(self, embedding: List[float], key: str, generation: int) -> Optional[Any]:
+        """Return the answer to the most similar past question, or None."""
+        with self._lock:
+            stale = [i for i, e in enumerate(self._entries) if e[1] != generation]
+            if stale:
+                stale_set = set(stale)
+                self._keep([i for i in range(len(self._entries)) if i not in stale_set])
+            best = None
+            if self._entries and self._vectors.shape[1] == len(embedding):
+                similarities = self._vectors @ self._unit(embedding)
+                for i in np.argsort(-similarities):
+                    if similarities[i] < self.threshold:
+                        break
+                    if self._entries[i][0] == key:
+                        best = self._entries[i][2]
+                        break
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return best
+
+    def set(
+        self, embedding: List[float], key: str, generation: int, answer: Any
+    ) -> None:
+        vector = self._unit(embedding)
+        with self._lock:
+            if len(self._entries) == 0 or self._vectors.shape[1] != len(vector):
+                self._vectors = np.empty((0, len(vector)), dtype=np.float32)
+                self._entries = []
+            self._vectors = np.vstack([self._vectors, vector[None]])
+            self._entries.append((key, generation, answer))
+            if len(self._entries) > self.max_size:
+                self._keep(
+                    list(range(len(self._entries) - self.max_size, len(self._entries)))
+                )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._vectors = np.empty((0, 0), dtype=np.float32)
+            self._entries = []
+        self.hits = 0
+        self.misses = 0
+
+    def empty(self) -> "AnswerCache":
+        """Return a new, empty cache with the same settings."""
+        return type(self)(threshold=self.threshold, max_size=self.max_size)
@@ -1,7 +1,12 @@
+import asyncio
+import json
 import re
-from typing import Any, Dict, List, Optional, cast
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple, Union, cast
 
 from langchain.base_language import BaseLanguageModel
+from langchain.callbacks.base import AsyncCallbackHandler
 from langchain.callbacks.manager import (
     AsyncCallbackManagerForChainRun,
     CallbackManagerForChainRun,
@@ -13,6 +18,7 @@ from langchain.prompts import PromptTemplate, StringPromptTemplate
 from langchain.prompts.chat import ChatPromptTemplate, HumanMessagePromptTemplate
 from langchain.schema import LLMResult, SystemMessage
 
+from .limiter import get_limiter, get_limiter_name
 from .prompts import default_system_prompt
 from .types import CBManager
 
@@ -27,6 +33,16 @@ memory_prompt = PromptTemplate(
 class FallbackLLMChain(LLMChain):
     """Chain that falls back to synchronous generation if the async generation fails."""
 
+    # memory whose variables are added to the inputs of each call
+    # (unlike LLMChain.memory, calls are not saved to it)
+    memory_model: Optional[BaseChatMemory] = None
+
+    def prep_inputs(self, inputs: Union[Dict[str, Any], Any]) -> Dict[str, str]:
+        if self.memory_model is not None and isinstance(inputs, dict):
+            # stored memory wins, e.g. over the empty memory field of an answer
+            inputs = {**inputs, **self.memory_model.load_memory_variables({})}
+        return super().prep_inputs(inputs)
+
     async def agenerate(
         self,
         input_list: List[Dict[str, Any]],
@@ -41,6 +57,16 @@ class FallbackLLMChain(LLMChain):
             return self.generate(input_list)
 
 
+class TokenQueueHandler(AsyncCallbackHandler):
+    """Puts tokens on a queue as the llm streams them."""
+
+    def __init__(self, queue: asyncio.Queue):
+        self.queue = queue
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.queue.put_nowait(token)
+
+
 # TODO: If upstream is fixed remove this
 
 
@@ -48,15 +74,14 @@ class ExtendedHumanMessagePromptTemplate(HumanMessagePromptTemplate):
     prompt: StringPromptTemplate
 
 
-def make_chain(
+def _build_chain(
     prompt: StringPromptTemplate,
     llm: BaseLanguageModel,
-    skip_system: bool = False,
-    memory: Optional[BaseChatMemory] = None,
-    system_prompt: str = default_system_prompt,
+    skip_system: bool,
+    memory: Optional[BaseChatMemory],
+    system_prompt: str,
 ) -> FallbackLLMChain:
-    if memory and len(memory.load_memory_variables({})["memory"]) > 0:
-        # we copy the prompt so we don't modify the original
+    if memory is not None:
         # TODO: Figure out pipeline prompts to avoid this
         # the problem with pipeline prompts is that
         # the memory is a constant (or partial), not  a prompt
@@ -65,14 +90,11 @@ def make_chain(
         assert isinstance(
             prompt, PromptTemplate
         ), "Memory only works with prompt templates - see comment above"
-        assert "memory" in memory.load_memory_variables({})
-        new_prompt = PromptTemplate(
-            input_variables=prompt.input_variables,
-            template=memory_prompt.format(
-                start=prompt.template, **memory.load_memory_variables({})
-            ),
+        # memory stays a variable, filled in by the chain on each call
+        prompt = PromptTemplate(
+            input_variables=prompt.input_variables + ["memory"],
+            template=memory_prompt.format(start=prompt.template, memory="{memory}"),
         )
-        prompt = new_prompt
     if type(llm) == ChatOpenAI:
         system_message_prompt = SystemMessage(content=system_prompt)
         human_message_prompt = ExtendedHumanMessagePromptTemplate(prompt=prompt)
@@ -82,8 +104,60 @@ def make_chain(
             chat_prompt = ChatPromptTemplate.from_messages(
                 [system_message_prompt, human_message_prompt]
             )
-        return FallbackLLMChain(prompt=chat_prompt, llm=llm)
-    return FallbackLLMChain(prompt=prompt, llm=llm)
+        return FallbackLLMChain(prompt=chat_prompt, llm=llm, memory_model=memory)
+    return FallbackLLMChain(prompt=prompt, llm=llm, memory_model=memory)
+
+
+# chains by the ids of their prompt, llm and memory (kept alive by the entry,
+# so the ids are not reused) and other settings, most recently used last
+_chains: "OrderedDict[tuple, Tuple[Any, ...]]" = OrderedDict()
+_chains_lock = threading.Lock()
+MAX_CACHED_CHAINS = 256
+
+
+def make_chain(
+    prompt: StringPromptTemplate,
+    llm: BaseLanguageModel,
+    skip_system: bool = False,
+    memory: Optional[BaseChatMemory] = None,
+    system_prompt: str = default_system_prompt,
+) -> FallbackLLMChain:
+    """Get a chain for the prompt and llm, reusing one made before if possible."""
+    if memory is not None:
+        variables = memory.load_memory_variables({})
+        assert "memory" in variables
+        if len(variables["memory"]) == 0:
+            # nothing to remember yet, so leave the prompt as it is
+            memory = None
+    key = (
+        id(prompt),
+        # in case the prompt was edited in place
+        getattr(prompt, "template", None),
+        id(llm),
+        skip_system,
+        id(memory),
+        system_prompt,
+    )
+    with _chains_lock:
+        if key in _chains:
+            _chains.move_to_end(key)
+            return _chains[key][-1]
+    chain = _build_chain(prompt, llm, skip_system, memory, system_prompt)
+    with _chains_lock:
+        _chains[key] = (prompt, llm, memory, chain)
+        while len(_chains) > MAX_CACHED_CHAINS:
+            _chains.popitem(last=False)
+    return chain
+
+
+async def arun_chain(chain: LLMChain, callbacks: Any = None, **inputs: Any) -> str:
+    """Run a chain through its model's limiter, retrying if it is rate limited."""
+    limiter = get_limiter(get_limiter_name(chain.llm))
+    # about 4 characters per token
+    tokens = sum(len(str(v)) for v in inputs.values()) // 4
+    return await limiter.call(
+        lambda: chain.arun(callbacks=callbacks, **inputs), tokens=tokens
+    )
 
 
 def get_score(text: str) -> int:
@@ -111,3 +185,31 @@ def get_score(text: str) -> int:
     if len(text) < 100:
         return 1
     return 5
+
+
+def parse_batch_summaries(text: str, n: int) -> Dict[int, str]:
+    """Parse the output of the batch summary prompt for n excerpts.
+
+    Returns the summaries by (0-based) excerpt, each formatted like the output
+    of the summary prompt: the summary with its score on a new line, so
+    get_score works as for single summaries. Missing or malformed excerpts
+    are left out.
+    """
+    start, end = text.find("["), text.rfind("]")
+    if start == -1 or end < start:
+        return {}
+    try:
+        items = json.loads(text[start : end + 1])
+    except ValueError:
+        return {}
+    summaries = {}
+    for item in items if isinstance(items, list) else []:
+        try:
+            i = int(item["excerpt"]) - 1
+            summary = str(item["summary"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 0 <= i < n:
+            score = item.get("score")
+            summaries[i] = summary if score is None else f"{summary}\n{score}"
+    return summaries
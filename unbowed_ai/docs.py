@@ -1,42 +1,136 @@
 import asyncio
+import copy
+import functools
+import inspect
 import os
+import pickle
 import re
-import sys
 import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from io import BytesIO
 from pathlib import Path
-from typing import BinaryIO, Dict, List, Optional, Set, Union, cast
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
 
+import numpy as np
 from langchain.chat_models import ChatOpenAI
+from langchain.docstore.document import Document
 from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.memory import ConversationTokenBufferMemory
+from langchain.memory import ChatMessageHistory, ConversationTokenBufferMemory
 from langchain.memory.chat_memory import BaseChatMemory
+from langchain.prompts import PromptTemplate
 from langchain.schema.embeddings import Embeddings
 from langchain.schema.language_model import BaseLanguageModel
 from langchain.schema.vectorstore import VectorStore
-from langchain.vectorstores import FAISS
 
 try:
-    from pydantic.v1 import BaseModel, validator
+    from pydantic.v1 import BaseModel, PrivateAttr, validator
 except ImportError:
-    from pydantic import BaseModel, validator
+    from pydantic import BaseModel, PrivateAttr, validator
 
-from .chains import get_score, make_chain
+from .cache import (
+    AnswerCache,
+    EmbeddingCache,
+    MemorySummaryCache,
+    ParseCache,
+    QueryEmbeddingCache,
+    SummaryCache,
+    make_cache_key,
+)
+from .chains import (
+    TokenQueueHandler,
+    arun_chain,
+    get_score,
+    make_chain,
+    parse_batch_summaries,
+)
+from .lexical import InvertedIndex, bm25_scores, reciprocal_rank_fusion
 from .paths import UNBOWED_AI_PATH
-from .readers import read_doc
+from .readers import DocSource, iter_doc, read_doc
+from .storage import (
+    STORAGE_VERSION,
+    ColumnarDocstore,
+    LazyTexts,
+    SortedIdMap,
+    StringColumn,
+)
 from .types import Answer, CallbackFactory, Context, Doc, DocKey, PromptCollection, Text
 from .utils import (
+    Buffer,
+    StrPath,
+    gather_until,
     gather_with_concurrency,
+    get_embedding_name,
+    get_llm_id,
     get_llm_name,
     guess_is_4xx,
-    maybe_is_html,
-    maybe_is_pdf,
+    iter_queue,
     maybe_is_text,
     md5sum,
     name_in_text,
+    read_and_hash,
+    record_time,
+    run_sync,
     strip_citations,
 )
+from .vectorstores import EmbeddingStore, IDMapFAISS
+
+# placeholder docname used when a document is parsed before its name is known
+_PENDING_DOCNAME = "__pending_docname__"
+
+
+def _parse_for_add(
+    path: Path,
+    dockey: Optional[DocKey],
+    chunk_chars: int,
+    cache: Optional[ParseCache] = None,
+) -> Tuple[DocKey, List[Text]]:
+    """Hash and parse a document. Runs in a worker process for add_many."""
+    file_hash = None
+    if dockey is None:
+        dockey = file_hash = md5sum(path)
+    doc = Doc(docname=_PENDING_DOCNAME, citation="", dockey=dockey)
+    texts = read_doc(
+        path,
+        doc,
+        chunk_chars=chunk_chars,
+        overlap=100,
+        cache=cache,
+        file_hash=file_hash,
+    )
+    return dockey, texts
+
+
+def _on_snapshot(method: Callable) -> Callable:
+    """Run a query method of Docs on a snapshot of it, see Docs.snapshot."""
+    if inspect.isasyncgenfunction(method):
+
+        @functools.wraps(method)
+        async def stream(self, *args, **kwargs):
+            async for event in method(self.snapshot(), *args, **kwargs):
+                yield event
+
+        return stream
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        return await method(self.snapshot(), *args, **kwargs)
+
+    return wrapper
 
 
 class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
@@ -56,12 +150,52 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
     embeddings: Embeddings = OpenAIEmbeddings(client=None)
     max_concurrent: int = 5
     deleted_dockeys: Set[DocKey] = set()
+    # chunks get stable integer ids, consecutive within a document
+    text_id_ranges: Dict[DocKey, Tuple[int, int]] = {}
+    next_text_id: int = 0
+    # deleted vectors are removed from the indexes once they are this fraction of them
+    compact_threshold: float = 0.2
     prompts: PromptCollection = PromptCollection()
     memory: bool = False
     memory_model: Optional[BaseChatMemory] = None
     jit_texts_index: bool = False
+    # parsed chunks are cached on disk by file hash, set to None to disable
+    parse_cache: Optional[ParseCache] = ParseCache()
+    # chunk embeddings are cached on disk by model and text, set to None to disable
+    embedding_cache: Optional[EmbeddingCache] = EmbeddingCache()
+    # questions are cached in memory by model and text, set to None to disable
+    query_embedding_cache: Optional[QueryEmbeddingCache] = QueryEmbeddingCache()
+    # chunk summaries are cached by question and everything else that goes into them
+    # (including memory). Use SQLiteSummaryCache to persist it, or None to disable
+    summary_cache: Optional[SummaryCache] = MemorySummaryCache()
+    # summarize several chunks per request, up to about this many tokens of them
+    batch_summaries: bool = False
+    summary_batch_tokens: int = 4000
+    # stop gathering evidence once max_sources contexts have at least this score,
+    # or after this many seconds, cancelling summaries still running
+    early_exit_score: Optional[int] = None
+    evidence_timeout: Optional[float] = None
+    # skip summarizing chunks whose BM25 score against the question is below
+    # this fraction of the best retrieved chunk's (chunks with no words from it go)
+    prefilter: Optional[float] = None
+    # also rank chunks by BM25 and fuse that with vector search. The inverted
+    # index of chunk words it needs is then kept up to date as texts change
+    hybrid_search: bool = False
+    inverted_index: Optional[InvertedIndex] = None
+    # set to an AnswerCache to reuse answers to (almost) the same question
+    answer_cache: Optional[AnswerCache] = None
+    # bumped whenever documents are added or deleted
+    generation: int = 0
+    # embeddings of texts, which refer to them by row. Use dtype="float16" to halve it
+    embedding_store: EmbeddingStore = EmbeddingStore()
     # This is used to strip indirect citations that come up from the summary llm
     strip_citations: bool = True
+    # writers (adding, deleting, compacting) take turns, and publish their
+    # changes at once under the publish lock, see snapshot
+    _write_lock: threading.RLock = PrivateAttr(default_factory=threading.RLock)
+    _publish_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    # for a snapshot, the collection it was taken of
+    _root: Optional["Docs"] = PrivateAttr(None)
 
     # TODO: Not sure how to get this to work
     # while also passing mypy checks
@@ -93,10 +227,55 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
             return values["memory_model"]
         return None
 
+    def snapshot(self) -> "Docs":
+        """Return a view of the collection as it is now, to query.
+
+        Writers never change the texts, indexes and such that the collection
+        has published. They build the next generation of them aside (sharing
+        what is only ever appended to, like embedding rows and index segments)
+        and then publish it at once, so queries on a snapshot neither see documents
+        added or deleted since, nor wait for them to be. Queries take a
+        snapshot themselves, which is cheap (a shallow copy). Snapshots are
+        read-only, apart from indexes built as they are needed.
+        """
+        if self._root is not None:
+            return self
+        with self._publish_lock:
+            view = self.copy()
+        view._root = self
+        return view
+
+    def _publish(self, **fields: Any) -> None:
+        """Replace fields at once, as the next generation of the collection."""
+        with self._publish_lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+
+    def _share(self, name: str, value: Any) -> None:
+        """Set a field built as it was needed, on the collection if still current.
+
+        So an index built by one query (on a snapshot) is not built again by
+        the next one, unless the collection has changed since.
+        """
+        old = getattr(self, name)
+        setattr(self, name, value)
+        root = self._root
+        if root is not None:
+            with root._publish_lock:
+                if root.generation == self.generation and getattr(root, name) is old:
+                    setattr(root, name, value)
+
     def clear_docs(self):
-        self.texts = []
-        self.docs = {}
-        self.docnames = set()
+        with self._write_lock:
+            self._publish(
+                texts=[],
+                docs={},
+                docnames=set(),
+                text_id_ranges={},
+                embedding_store=EmbeddingStore(self.embedding_store.dtype),
+                inverted_index=None,
+                generation=self.generation + 1,
+            )
 
     def update_llm(
         self,
@@ -113,10 +292,11 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
             summary_llm = llm
         self.summary_llm = cast(BaseLanguageModel, summary_llm)
 
-    def _get_unique_name(self, docname: str) -> str:
+    def _get_unique_name(self, docname: str, taken: Optional[Set[str]] = None) -> str:
         """Create a unique name given proposed name"""
+        taken = self.docnames if taken is None else self.docnames | taken
         suffix = ""
-        while docname + suffix in self.docnames:
+        while docname + suffix in taken:
             # move suffix to next letter
             if suffix == "":
                 suffix = "a"
@@ -134,23 +314,16 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
         chunk_chars: int = 3000,
     ) -> Optional[str]:
         """Add a document to the collection."""
-        # just put in temp file and use existing method
-        suffix = ".txt"
-        if maybe_is_pdf(file):
-            suffix = ".pdf"
-        elif maybe_is_html(file):
-            suffix = ".html"
-
-        with tempfile.NamedTemporaryFile(suffix=suffix) as f:
-            f.write(file.read())
-            f.seek(0)
-            return self.add(
-                Path(f.name),
-                citation=citation,
-                docname=docname,
-                dockey=dockey,
-                chunk_chars=chunk_chars,
-            )
+        # read (hashing as we go) and parse from memory, without a temp file
+        buffer, file_hash = read_and_hash(file)
+        return self.add_buffer(
+            buffer,
+            citation=citation,
+            docname=docname,
+            dockey=dockey,
+            chunk_chars=chunk_chars,
+            file_hash=file_hash,
+        )
 
     def add_url(
         self,
@@ -164,15 +337,45 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
         import urllib.request
 
         with urllib.request.urlopen(url) as f:
-            # need to wrap to enable seek
-            file = BytesIO(f.read())
-            return self.add_file(
-                file,
-                citation=citation,
-                docname=docname,
-                dockey=dockey,
-                chunk_chars=chunk_chars,
-            )
+            buffer, file_hash = read_and_hash(f)
+        return self.add_buffer(
+            buffer,
+            citation=citation,
+            docname=docname,
+            dockey=dockey,
+            chunk_chars=chunk_chars,
+            file_hash=file_hash,
+            name=url,
+        )
+
+    def add_buffer(
+        self,
+        buffer: Buffer,
+        citation: Optional[str] = None,
+        docname: Optional[str] = None,
+        disable_check: bool = False,
+        dockey: Optional[DocKey] = None,
+        chunk_chars: int = 3000,
+        file_hash: Optional[str] = None,
+        name: str = "buffer",
+    ) -> Optional[str]:
+        """Add a document held in memory (e.g. the bytes of an upload) to the collection.
+
+        The document type is guessed from its first bytes. ``name`` is only used
+        in error messages and fallback citations.
+        """
+        if dockey is None:
+            dockey = file_hash = file_hash or md5sum(buffer)
+        return self._add(
+            buffer,
+            name,
+            citation=citation,
+            docname=docname,
+            disable_check=disable_check,
+            dockey=dockey,
+            chunk_chars=chunk_chars,
+            file_hash=file_hash,
+        )
 
     def add(
         self,
@@ -184,8 +387,44 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
         chunk_chars: int = 3000,
     ) -> Optional[str]:
         """Add a document to the collection."""
+        file_hash = None
         if dockey is None:
-            dockey = md5sum(path)
+            dockey = file_hash = md5sum(path)
+        return self._add(
+            path,
+            str(path),
+            citation=citation,
+            docname=docname,
+            disable_check=disable_check,
+            dockey=dockey,
+            chunk_chars=chunk_chars,
+            file_hash=file_hash,
+        )
+
+    def _add(
+        self,
+        source: DocSource,
+        name: str,
+        citation: Optional[str],
+        docname: Optional[str],
+        disable_check: bool,
+        dockey: DocKey,
+        chunk_chars: int,
+        file_hash: Optional[str],
+    ) -> Optional[str]:
+        # parse lazily and only once - the docname is applied after the first chunk
+        pending_doc = Doc(docname=_PENDING_DOCNAME, citation="", dockey=dockey)
+        chunks = iter_doc(
+            source,
+            pending_doc,
+            chunk_chars=chunk_chars,
+            overlap=100,
+            cache=self.parse_cache,
+            file_hash=file_hash,
+        )
+        first = next(chunks, None)
+        if first is None:
+            raise ValueError(f"Could not read document {name}. Is it empty?")
         if citation is None:
             # skip system because it's too hesitant to answer
             cite_chain = make_chain(
@@ -194,34 +433,49 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
                 skip_system=True,
             )
             # peak first chunk
-            fake_doc = Doc(docname="", citation="", dockey=dockey)
-            texts = read_doc(path, fake_doc, chunk_chars=chunk_chars, overlap=100)
-            if len(texts) == 0:
-                raise ValueError(f"Could not read document {path}. Is it empty?")
-            citation = cite_chain.run(texts[0].text)
+            citation = cite_chain.run(first.text)
             if len(citation) < 3 or "Unknown" in citation or "insufficient" in citation:
-                citation = f"Unknown, {os.path.basename(path)}, {datetime.now().year}"
+                citation = f"Unknown, {os.path.basename(name)}, {datetime.now().year}"
 
         if docname is None:
-            # get first name and year from citation
-            match = re.search(r"([A-Z][a-z]+)", citation)
-            if match is not None:
-                author = match.group(1)  # type: ignore
-            else:
-                # panicking - no word??
-                raise ValueError(
-                    f"Could not parse docname from citation {citation}. "
-                    "Consider just passing key explicitly - e.g. docs.py "
-                    "(path, citation, key='mykey')"
-                )
-            year = ""
-            match = re.search(r"(\d{4})", citation)
-            if match is not None:
-                year = match.group(1)  # type: ignore
-            docname = f"{author}{year}"
+            docname = self._docname_from_citation(citation)
         docname = self._get_unique_name(docname)
         doc = Doc(docname=docname, citation=citation, dockey=dockey)
-        texts = read_doc(path, doc, chunk_chars=chunk_chars, overlap=100)
+        self._check_texts([first], name, disable_check)
+        texts = self._name_texts([first, *chunks], doc)
+        if self.add_texts(texts, doc):
+            return docname
+        return None
+
+    @staticmethod
+    def _name_texts(texts: List[Text], doc: Doc) -> List[Text]:
+        """Assign a document to texts that were parsed before it was named."""
+        for t in texts:
+            t.name = t.name.replace(_PENDING_DOCNAME, doc.docname)
+            t.doc = doc
+        return texts
+
+    @staticmethod
+    def _docname_from_citation(citation: str) -> str:
+        # get first name and year from citation
+        match = re.search(r"([A-Z][a-z]+)", citation)
+        if match is not None:
+            author = match.group(1)  # type: ignore
+        else:
+            # panicking - no word??
+            raise ValueError(
+                f"Could not parse docname from citation {citation}. "
+                "Consider just passing key explicitly - e.g. docs.py "
+                "(path, citation, key='mykey')"
+            )
+        year = ""
+        match = re.search(r"(\d{4})", citation)
+        if match is not None:
+            year = match.group(1)  # type: ignore
+        return f"{author}{year}"
+
+    @staticmethod
+    def _check_texts(texts: List[Text], path: StrPath, disable_check: bool) -> None:
         # loose check to see if document was loaded
         if (
             len(texts) == 0
@@ -231,9 +485,156 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
             raise ValueError(
                 f"This does not look like a text document: {path}. Path disable_check to ignore this error."
             )
-        if self.add_texts(texts, doc):
-            return docname
-        return None
+
+    def add_many(
+        self,
+        paths: List[Path],
+        citations: Optional[List[Optional[str]]] = None,
+        docnames: Optional[List[Optional[str]]] = None,
+        dockeys: Optional[List[Optional[DocKey]]] = None,
+        disable_check: bool = False,
+        chunk_chars: int = 3000,
+        max_workers: Optional[int] = None,
+        embedding_batch_size: int = 1000,
+    ) -> Dict[Path, Union[Optional[str], Exception]]:
+        """Add many documents to the collection, parsing them in parallel."""
+        return run_sync(
+            self.aadd_many(
+                paths,
+                citations=citations,
+                docnames=docnames,
+                dockeys=dockeys,
+                disable_check=disable_check,
+                chunk_chars=chunk_chars,
+                max_workers=max_workers,
+                embedding_batch_size=embedding_batch_size,
+            )
+        )
+
+    async def aadd_many(
+        self,
+        paths: List[Path],
+        citations: Optional[List[Optional[str]]] = None,
+        docnames: Optional[List[Optional[str]]] = None,
+        dockeys: Optional[List[Optional[DocKey]]] = None,
+        disable_check: bool = False,
+        chunk_chars: int = 3000,
+        max_workers: Optional[int] = None,
+        embedding_batch_size: int = 1000,
+    ) -> Dict[Path, Union[Optional[str], Exception]]:
+        """Add many documents to the collection, parsing them in parallel.
+
+        Documents are parsed across a process pool (one worker per core by default),
+        their chunks are embedded in large batches and then committed in bulk.
+
+        Returns a dict mapping each path to its docname, None if it was
+        already in the collection, or the exception raised while adding it.
+        """
+        citations = citations or [None] * len(paths)
+        docnames = docnames or [None] * len(paths)
+        dockeys = dockeys or [None] * len(paths)
+        if not len(paths) == len(citations) == len(docnames) == len(dockeys):
+            raise ValueError("citations, docnames and dockeys must match paths.")
+        results: Dict[Path, Union[Optional[str], Exception]] = {}
+
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            parsed = await asyncio.gather(
+                *[
+                    loop.run_in_executor(
+                        executor,
+                        _parse_for_add,
+                        path,
+                        dockey,
+                        chunk_chars,
+                        self.parse_cache,
+                    )
+                    for path, dockey in zip(paths, dockeys)
+                ],
+                return_exceptions=True,
+            )
+
+        async def make_doc(
+            path: Path,
+            parse: Union[Tuple[DocKey, List[Text]], BaseException],
+            citation: Optional[str],
+            docname: Optional[str],
+        ) -> Optional[Tuple[List[Text], Doc]]:
+            if isinstance(parse, BaseException):
+                raise parse
+            dockey, texts = parse
+            if dockey in self.docs:
+                return None
+            if len(texts) == 0:
+                raise ValueError(f"Could not read document {path}. Is it empty?")
+            if citation is None:
+                # skip system because it's too hesitant to answer
+                cite_chain = make_chain(
+                    prompt=self.prompts.cite,
+                    llm=cast(BaseLanguageModel, self.summary_llm),
+                    skip_system=True,
+                )
+                citation = await arun_chain(cite_chain, text=texts[0].text)
+                if (
+                    len(citation) < 3
+                    or "Unknown" in citation
+                    or "insufficient" in citation
+                ):
+                    citation = (
+                        f"Unknown, {os.path.basename(path)}, {datetime.now().year}"
+                    )
+            if docname is None:
+                docname = self._docname_from_citation(citation)
+            self._check_texts(texts, path, disable_check)
+            doc = Doc(docname=docname, citation=citation, dockey=dockey)
+            return self._name_texts(texts, doc), doc
+
+        async def safe_make_doc(*args):
+            try:
+                return await make_doc(*args)
+            except Exception as e:
+                return e
+
+        made = await gather_with_concurrency(
+            self.max_concurrent,
+            *[safe_make_doc(*args) for args in zip(paths, parsed, citations, docnames)],
+        )
+
+        # pack chunks from many documents into large embedding batches
+        batch: List[Tuple[Path, List[Text], Doc]] = []
+        batch_size = 0
+        seen: Set[DocKey] = set()
+        for i, (path, m) in enumerate(zip(paths, made)):
+            if isinstance(m, Exception) or m is None:
+                results[path] = m
+            elif m[1].dockey in seen:
+                # same file listed twice
+                results[path] = None
+            else:
+                seen.add(m[1].dockey)
+                batch.append((path, *m))
+                batch_size += len(m[0])
+            if batch and (batch_size >= embedding_batch_size or i == len(paths) - 1):
+                try:
+                    # in a thread, so queries on the event loop go on meanwhile
+                    await loop.run_in_executor(
+                        None,
+                        self._embed_texts,
+                        [t for _, texts, _ in batch for t in texts],
+                    )
+                    added = await loop.run_in_executor(
+                        None,
+                        self._commit_texts,
+                        [(texts, doc) for _, texts, doc in batch],
+                    )
+                    for (p, _, doc), a in zip(batch, added):
+                        results[p] = doc.docname if a else None
+                except Exception as e:
+                    for p, _, _ in batch:
+                        results[p] = e
+                batch = []
+                batch_size = 0
+        return results
 
     def add_texts(
         self,
@@ -248,68 +649,366 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
             return False
         if len(texts) == 0:
             raise ValueError("No texts to add.")
-        if doc.docname in self.docnames:
-            new_docname = self._get_unique_name(doc.docname)
-            for t in texts:
-                t.name = t.name.replace(doc.docname, new_docname)
-            doc.docname = new_docname
-        if texts[0].embeddings is None:
-            text_embeddings = self.embeddings.embed_documents([t.text for t in texts])
-            for i, t in enumerate(texts):
-                t.embeddings = text_embeddings[i]
-        else:
-            text_embeddings = cast(List[List[float]], [t.embeddings for t in texts])
-        if self.texts_index is not None:
-            try:
-                # TODO: Simplify - super weird
-                vec_store_text_and_embeddings = list(
-                    map(lambda x: (x.text, x.embeddings), texts)
+        self._embed_texts(texts)
+        return self._commit_texts([(texts, doc)])[0]
+
+    def _embed_texts(self, texts: List[Text]) -> None:
+        """Embed (in one batched call) any texts that do not have embeddings yet."""
+        to_embed = [t for t in texts if t.embeddings is None]
+        if len(to_embed) == 0:
+            return
+        for t, e in zip(to_embed, self._embed([t.text for t in to_embed])):
+            t.embeddings = e
+
+    def _embed(self, strings: List[str]) -> List[List[float]]:
+        """Embed strings in one batched call.
+
+        Only strings missing from the embedding cache are sent to the embedding model.
+        """
+        model = get_embedding_name(self.embeddings)
+        embeddings: List[Optional[List[float]]] = [None] * len(strings)
+        if self.embedding_cache is not None:
+            embeddings = self.embedding_cache.get_many(model, strings)
+        # identical strings only need to be embedded once
+        missing = list(
+            dict.fromkeys(s for s, e in zip(strings, embeddings) if e is None)
+        )
+        if len(missing) > 0:
+            new = dict(zip(missing, self.embeddings.embed_documents(missing)))
+            embeddings = [
+                new[s] if e is None else e for s, e in zip(strings, embeddings)
+            ]
+            if self.embedding_cache is not None:
+                self.embedding_cache.set_many(model, missing, [new[s] for s in missing])
+        return cast(List[List[float]], embeddings)
+
+    def _embed_query(self, query: str) -> List[float]:
+        """Embed a question, using the query embedding cache."""
+        if self.query_embedding_cache is None:
+            return self.embeddings.embed_query(query)
+        model = get_embedding_name(self.embeddings)
+        embedding = self.query_embedding_cache.get(model, query)
+        if embedding is None:
+            embedding = self.embeddings.embed_query(query)
+            self.query_embedding_cache.set(model, query, embedding)
+        return embedding
+
+    async def _aembed_queries(self, queries: List[str]) -> List[List[float]]:
+        """Embed questions in threads, a few at a time.
+
+        Each goes through _embed_query, not embed_documents, since some models
+        embed questions differently and the query embedding cache is shared.
+        """
+        loop = asyncio.get_running_loop()
+
+        async def embed(query: str) -> List[float]:
+            return await loop.run_in_executor(None, self._embed_query, query)
+
+        return await gather_with_concurrency(
+            self.max_concurrent, *[embed(q) for q in queries]
+        )
+
+    def _question_embedding(self, answer: Answer) -> List[float]:
+        if answer.question_embedding is None:
+            answer.question_embedding = self._embed_query(answer.question)
+        return answer.question_embedding
+
+    async def _aquestion_embedding(self, answer: Answer) -> List[float]:
+        """Embed the question in a thread, so the event loop is not blocked."""
+        if answer.question_embedding is None:
+            answer.question_embedding = (
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._embed_query, answer.question
+                )
+            )
+        return answer.question_embedding
+
+    def _commit_texts(self, batch: List[Tuple[List[Text], Doc]]) -> List[bool]:
+        """Add embedded texts for one or more documents, updating the indexes in bulk.
+
+        The indexes are changed on copies, which are then published with the
+        new texts at once (see snapshot). Returns whether each document was added.
+        """
+        with self._write_lock:
+            added: List[bool] = []
+            new_texts: List[Text] = []
+            new_docs: List[Doc] = []
+            new_docnames: Set[str] = set()
+            for texts, doc in batch:
+                if doc.dockey in self.docs or doc.dockey in [
+                    d.dockey for d in new_docs
+                ]:
+                    added.append(False)
+                    continue
+                if doc.docname in self.docnames or doc.docname in new_docnames:
+                    new_docname = self._get_unique_name(doc.docname, new_docnames)
+                    for t in texts:
+                        t.name = t.name.replace(doc.docname, new_docname)
+                    doc.docname = new_docname
+                new_docnames.add(doc.docname)
+                # texts belong to the document they are added with, so their
+                # ids (see _text_ids) are counted from its range
+                for t in texts:
+                    t.doc = doc
+                new_texts += texts
+                new_docs.append(doc)
+                added.append(True)
+            if len(new_docs) == 0:
+                return added
+            id_ranges = {}
+            next_text_id = self.next_text_id
+            for (texts, doc), was_added in zip(batch, added):
+                if was_added:
+                    id_ranges[doc.dockey] = (next_text_id, next_text_id + len(texts))
+                    next_text_id += len(texts)
+            if isinstance(self.doc_index, IDMapFAISS):
+                # before any index is changed, in case embedding fails
+                citation_embeddings = np.array(
+                    self._embed([d.citation for d in new_docs])
+                )
+            # move the embeddings out of the texts, into one matrix. Rows are
+            # only appended, so snapshots can keep using the store
+            rows = self.embedding_store.append([t.embeddings for t in new_texts])
+            for t, row in zip(new_texts, rows):
+                t.row = row
+                t.embeddings = None
+            texts_index = self.texts_index
+            if texts_index is not None:
+                ids = [i for r in id_ranges.values() for i in range(*r)]
+                metadatas = [self._text_metadata(t) for t in new_texts]
+                if isinstance(texts_index, IDMapFAISS):
+                    texts_index = texts_index.copy()
+                    texts_index.add_vectors(
+                        [t.text for t in new_texts],
+                        self.embedding_store[rows.start : rows.stop],
+                        metadatas=metadatas,
+                        ids=ids,
+                    )
+                else:
+                    # other vector stores cannot be copied, so are changed in place
+                    try:
+                        texts_index.add_embeddings(  # type: ignore
+                            list(
+                                zip(
+                                    [t.text for t in new_texts],
+                                    self.embedding_store[
+                                        rows.start : rows.stop
+                                    ].tolist(),
+                                )
+                            ),
+                            metadatas=metadatas,
+                        )
+                    except AttributeError:
+                        raise ValueError(
+                            "Need a vector store that supports adding embeddings."
+                        )
+            doc_index = self.doc_index
+            if isinstance(doc_index, IDMapFAISS):
+                # a document is indexed by the id of its first chunk
+                doc_index = doc_index.copy()
+                doc_index.add_vectors(
+                    [d.citation for d in new_docs],
+                    citation_embeddings,
+                    metadatas=[d.dict() for d in new_docs],
+                    ids=[id_ranges[d.dockey][0] for d in new_docs],
+                )
+            elif doc_index is not None:
+                doc_index.add_texts(
+                    [d.citation for d in new_docs],
+                    metadatas=[d.dict() for d in new_docs],
                 )
-                self.texts_index.add_embeddings(  # type: ignore
-                    vec_store_text_and_embeddings,
-                    metadatas=[t.dict(exclude={"embeddings", "text"}) for t in texts],
+            inverted_index = self.inverted_index
+            if inverted_index is not None and len(inverted_index) == len(self.texts):
+                inverted_index = inverted_index.copy()
+                inverted_index.add(
+                    [i for r in id_ranges.values() for i in range(*r)],
+                    [t.text for t in new_texts],
                 )
-            except AttributeError:
-                raise ValueError("Need a vector store that supports adding embeddings.")
-        if self.doc_index is not None:
-            self.doc_index.add_texts([doc.citation], metadatas=[doc.dict()])
-        self.docs[doc.dockey] = doc
-        self.texts += texts
-        self.docnames.add(doc.docname)
-        return True
+            self._publish(
+                docs={**self.docs, **{doc.dockey: doc for doc in new_docs}},
+                texts=[*self.texts, *new_texts],
+                docnames=self.docnames | new_docnames,
+                text_id_ranges={**self.text_id_ranges, **id_ranges},
+                next_text_id=next_text_id,
+                texts_index=texts_index,
+                doc_index=doc_index,
+                inverted_index=inverted_index,
+                generation=self.generation + 1,
+            )
+            if self.doc_index is None:
+                self._build_doc_index()
+            if self.hybrid_search:
+                self._get_inverted_index()
+        return added
+
+    def _build_doc_index(self) -> None:
+        """Build the index of document citations used by adoc_match.
+
+        It is then kept up to date as documents are added and deleted,
+        so citations are only embedded when documents are added.
+        """
+        if len(self.docs) == 0:
+            return
+        docs = list(self.docs.values())
+        citations = [d.citation for d in docs]
+        self._share(
+            "doc_index",
+            IDMapFAISS.from_vectors(
+                citations,
+                np.array(self._embed(citations)),
+                embedding=self.embeddings,
+                metadatas=[d.dict() for d in docs],
+                ids=[self.text_id_ranges[d.dockey][0] for d in docs],
+            ),
+        )
+
+    def _get_inverted_index(self) -> InvertedIndex:
+        """Return the inverted index of texts, (re)building it if missing or stale."""
+        if self.inverted_index is None or len(self.inverted_index) != len(self.texts):
+            inverted_index = InvertedIndex()
+            inverted_index.add(self._text_ids(self.texts), [t.text for t in self.texts])
+            self._share("inverted_index", inverted_index)
+        return cast(InvertedIndex, self.inverted_index)
+
+    @staticmethod
+    def _text_metadata(text: Text) -> dict:
+        return text.dict(exclude={"embeddings", "text", "row"})
+
+    def _text_ids(self, texts: List[Text]) -> List[int]:
+        """Return the stable ids of (all, in order) the texts of some documents."""
+        offsets: Dict[DocKey, int] = {}
+        ids = []
+        for t in texts:
+            offset = offsets.get(t.doc.dockey, 0)
+            offsets[t.doc.dockey] = offset + 1
+            ids.append(self.text_id_ranges[t.doc.dockey][0] + offset)
+        return ids
 
     def delete(
         self, name: Optional[str] = None, dockey: Optional[DocKey] = None
     ) -> None:
-        """Delete a document from the collection."""
-        if name is not None:
-            doc = next((doc for doc in self.docs.values() if doc.docname == name), None)
-            if doc is None:
-                return
-            self.docnames.remove(doc.docname)
-            dockey = doc.dockey
-        del self.docs[dockey]
-        self.deleted_dockeys.add(dockey)
+        """Delete a document from the collection.
 
+        Its texts are removed and its vectors are deleted from the indexes by id
+        (see compact). Vector stores that cannot delete by id instead have the
+        document filtered out of search results.
+        """
+        with self._write_lock:
+            if name is not None:
+                doc = next(
+                    (doc for doc in self.docs.values() if doc.docname == name), None
+                )
+                if doc is None:
+                    return
+                dockey = doc.dockey
+            docs = dict(self.docs)
+            doc = docs.pop(dockey)
+            text_id_ranges = dict(self.text_id_ranges)
+            start, stop = text_id_ranges.pop(dockey, (0, 0))
+            deleted_dockeys = self.deleted_dockeys
+            indexes = {}
+            for field, ids in [
+                ("texts_index", range(start, stop)),
+                ("doc_index", [start]),
+            ]:
+                index = getattr(self, field)
+                if isinstance(index, IDMapFAISS):
+                    # only tombstones change
+                    index = index.copy()
+                    index.delete(list(ids))
+                elif index is not None:
+                    deleted_dockeys = deleted_dockeys | {dockey}
+                indexes[field] = index
+            inverted_index = self.inverted_index
+            if inverted_index is not None:
+                inverted_index = inverted_index.copy()
+                inverted_index.delete(range(start, stop))
+            self._publish(
+                docs=docs,
+                docnames=self.docnames - {doc.docname},
+                texts=[t for t in self.texts if t.doc.dockey != dockey],
+                text_id_ranges=text_id_ranges,
+                deleted_dockeys=deleted_dockeys,
+                inverted_index=inverted_index,
+                generation=self.generation + 1,
+                **indexes,
+            )
+            self.compact(force=False)
+
+    def compact(self, force: bool = True) -> None:
+        """Physically remove deleted vectors from the indexes.
+
+        Unless forced, an index (or the embedding store) is only compacted
+        once deleted vectors make up more than compact_threshold of it.
+        """
+        with self._write_lock:
+            fields = self._compacted(force)
+            if len(fields) > 0:
+                self._publish(**fields)
+
+    def _compacted(self, force: bool) -> Dict[str, Any]:
+        """Compacted copies of the fields compact would replace."""
+        with self._write_lock:
+            fields: Dict[str, Any] = {}
+            n_rows = len(self.embedding_store)
+            # rows of deleted texts are all that is removed
+            if n_rows > len(self.texts) and (
+                force or (n_rows - len(self.texts)) / n_rows > self.compact_threshold
+            ):
+                store = copy.copy(self.embedding_store)
+                store.compact([t.row for t in self.texts])
+                fields["embedding_store"] = store
+                # snapshots still use the old rows, so the texts are copied
+                fields["texts"] = [
+                    t.copy(update={"row": row}) for row, t in enumerate(self.texts)
+                ]
+            for field in ["texts_index", "doc_index"]:
+                index = getattr(self, field)
+                if (
+                    isinstance(index, IDMapFAISS)
+                    and len(index.deleted) > 0
+                    and (force or index.deleted_fraction > self.compact_threshold)
+                ):
+                    fields[field] = index.copy()
+                    fields[field].compact()
+            if self.inverted_index is not None and (
+                force or self.inverted_index.deleted_fraction > self.compact_threshold
+            ):
+                fields["inverted_index"] = self.inverted_index.copy()
+                fields["inverted_index"].compact()
+            return fields
+
+    @_on_snapshot
     async def adoc_match(
         self,
         query: str,
         k: int = 25,
         rerank: Optional[bool] = None,
         get_callbacks: CallbackFactory = lambda x: None,
+        query_embedding: Optional[List[float]] = None,
     ) -> Set[DocKey]:
-        """Return a list of dockeys that match the query."""
-        if self.doc_index is None:
-            if len(self.docs) == 0:
-                return set()
-            texts = [doc.citation for doc in self.docs.values()]
-            metadatas = [d.dict() for d in self.docs.values()]
-            self.doc_index = FAISS.from_texts(
-                texts, metadatas=metadatas, embedding=self.embeddings
-            )
-        matches = self.doc_index.max_marginal_relevance_search(
-            query, k=k + len(self.deleted_dockeys)
-        )
+        """Return a list of dockeys that match the query.
+
+        Pass query_embedding if the query was already embedded (e.g. for aget_evidence).
+        """
+
+        def search() -> List[Document]:
+            if self.doc_index is None:
+                # only for collections pickled before the doc index was saved
+                self._build_doc_index()
+            if self.doc_index is None:
+                return []
+            if isinstance(self.doc_index, IDMapFAISS):
+                return self.doc_index.max_marginal_relevance_search_by_vector(
+                    query_embedding or self._embed_query(query),
+                    k=k + len(self.deleted_dockeys),
+                )
+            return self.doc_index.max_marginal_relevance_search(
+                query, k=k + len(self.deleted_dockeys)
+            )
+
+        # embedding and searching block, so they run in a thread
+        matches = await asyncio.get_running_loop().run_in_executor(None, search)
         # filter the matches
         matches = [
             m for m in matches if m.metadata["dockey"] not in self.deleted_dockeys
@@ -334,7 +1033,8 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
                     skip_system=True,
                 )
                 papers = [f"{d.docname}: {d.citation}" for d in matched_docs]
-                result = await chain.arun(  # type: ignore
+                result = await arun_chain(  # type: ignore
+                    chain,
                     question=query,
                     papers="\n".join(papers),
                     callbacks=get_callbacks("filter"),
@@ -345,48 +1045,415 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
         return set([d.dockey for d in matched_docs])
 
     def __getstate__(self):
-        state = self.__dict__.copy()
-        if self.texts_index is not None and self.index_path is not None:
+        # the stores below compact themselves when saved, so do it first, on
+        # copies that are only pickled (the collection itself is unchanged)
+        with self._write_lock:
+            state = self.__dict__.copy()
+            state.update(self._compacted(force=True))
+        if state["texts_index"] is not None and self.index_path is not None:
             state["texts_index"].save_local(self.index_path)
+        doc_index = state.pop("doc_index")
         del state["texts_index"]
-        del state["doc_index"]
+        if isinstance(doc_index, IDMapFAISS):
+            # it is small, so it is kept in the pickle
+            state["doc_index_bytes"] = doc_index.serialize_index()
         return {"__dict__": state, "__fields_set__": self.__fields_set__}
 
     def __setstate__(self, state):
+        doc_index_bytes = state["__dict__"].pop("doc_index_bytes", None)
+        # fill in fields added since the object was pickled
+        for name, field in self.__fields__.items():
+            if name not in state["__dict__"]:
+                state["__dict__"][name] = field.get_default()
         object.__setattr__(self, "__dict__", state["__dict__"])
         object.__setattr__(self, "__fields_set__", state["__fields_set__"])
+        self._init_private_attributes()
         try:
-            self.texts_index = FAISS.load_local(self.index_path, self.embeddings)
+            self.texts_index = IDMapFAISS.load_local(self.index_path, self.embeddings)
         except Exception:
             # they use some special exception type, but I don't want to import it
             self.texts_index = None
         self.doc_index = None
+        if len(self.text_id_ranges) < len(self.docs) or (
+            self.texts_index is not None and not self.texts_index.has_ids
+        ):
+            # pickled before texts had ids, so number them and rebuild the index
+            counts = Counter(t.doc.dockey for t in self.texts)
+            for dockey, n in counts.items():
+                self.text_id_ranges[dockey] = (self.next_text_id, self.next_text_id + n)
+                self.next_text_id += n
+            self.texts_index = None
+        if doc_index_bytes is not None:
+            self._load_doc_index(doc_index_bytes)
+        unstored = [t for t in self.texts if getattr(t, "row", None) is None]
+        if len(unstored) > 0:
+            # pickled before the embedding store, when texts held their embeddings
+            rows = self.embedding_store.append([t.embeddings for t in unstored])
+            for t, row in zip(unstored, rows):
+                t.row = row
+                t.embeddings = None
+
+    def _load_doc_index(self, index: bytes) -> None:
+        """Restore a doc index saved with serialize_index, unless it is out of date."""
+        docs = list(self.docs.values())
+        ids = [self.text_id_ranges[d.dockey][0] for d in docs]
+        doc_index = IDMapFAISS.from_index(
+            index,
+            self.embeddings,
+            texts=[d.citation for d in docs],
+            metadatas=[d.dict() for d in docs],
+            ids=ids,
+        )
+        if doc_index.ids == set(ids):
+            self.doc_index = doc_index
+
+    def save(self, path: StrPath) -> None:
+        """Save the collection to a directory, to be opened quickly with Docs.load.
+
+        The texts index is saved if it was built by Docs. Other vector stores
+        are not saved and must be set again after loading.
+        """
+        with self._write_lock:
+            self._save(Path(path))
+
+    def _save(self, path: Path) -> None:
+        path.mkdir(parents=True, exist_ok=True)
+        # drop deleted vectors, so rows follow the order of texts
+        self.compact()
+        ids = np.array(self._text_ids(self.texts), dtype=np.int64)
+        # chunks are stored in id order, so they can be looked up by id
+        order = np.argsort(ids, kind="stable")
+        texts = [self.texts[i] for i in order]
+        rows = np.array([t.row for t in texts], dtype=np.int64)
+        if np.array_equal(rows, np.arange(len(self.embedding_store))):
+            vectors = self.embedding_store.matrix
+        else:
+            vectors = self.embedding_store[rows]
+        dockeys = list(self.docs)
+        positions = {dockey: i for i, dockey in enumerate(dockeys)}
+        state = self.__dict__.copy()
+        for name in [
+            "texts",
+            "texts_index",
+            "doc_index",
+            "embedding_store",
+            "inverted_index",
+        ]:
+            del state[name]
+        self._empty_runtime_state(state)
+        catalog = {
+            "version": STORAGE_VERSION,
+            "state": state,
+            "fields_set": self.__fields_set__,
+            "dockeys": dockeys,
+        }
+        # files are written aside and then moved into place, so a collection
+        # loaded from this directory keeps reading its (replaced) files
+        with tempfile.TemporaryDirectory(dir=path) as tmpdir:
+            tmp = Path(tmpdir)
+            StringColumn.write(tmp / "text.bin", (t.text for t in texts))
+            StringColumn.write(tmp / "name.bin", (t.name for t in texts))
+            np.save(
+                tmp / "text_doc.npy",
+                np.array([positions[t.doc.dockey] for t in texts], dtype=np.int32),
+            )
+            np.save(tmp / "text_ids.npy", ids[order])
+            np.save(tmp / "embeddings.npy", vectors)
+            if isinstance(self.texts_index, IDMapFAISS):
+                self.texts_index.save_index(tmp / "texts_index.faiss")
+            elif (path / "texts_index.faiss").exists():
+                os.remove(path / "texts_index.faiss")
+            if isinstance(self.doc_index, IDMapFAISS):
+                with open(tmp / "doc_index.faiss", "wb") as f:
+                    f.write(self.doc_index.serialize_index())
+            elif (path / "doc_index.faiss").exists():
+                os.remove(path / "doc_index.faiss")
+            if self.inverted_index is not None:
+                self.inverted_index.save(tmp)
+            else:
+                for file in path.glob("lexical*"):
+                    os.remove(file)
+            with open(tmp / "catalog.pkl", "wb") as f:
+                pickle.dump(catalog, f)
+            # the catalog goes last, so a partly saved directory cannot be loaded
+            for file in sorted(tmp.iterdir(), key=lambda f: f.name == "catalog.pkl"):
+                os.replace(file, path / file.name)
+
+    @staticmethod
+    def _empty_runtime_state(state: Dict[str, Any]) -> None:
+        """Replace in-memory caches and the conversation in state with empty ones.
+
+        They are not settings of the collection, so they are saved without
+        their contents, keeping only how they are set up.
+        """
+        for name in ["query_embedding_cache", "summary_cache", "answer_cache"]:
+            cache = state.get(name)
+            if isinstance(
+                cache, (QueryEmbeddingCache, MemorySummaryCache, AnswerCache)
+            ):
+                state[name] = cache.empty()
+        memory_model = state.get("memory_model")
+        if memory_model is not None and isinstance(
+            memory_model.chat_memory, ChatMessageHistory
+        ):
+            state["memory_model"] = memory_model.copy(
+                update={"chat_memory": ChatMessageHistory()}
+            )
+
+    @classmethod
+    def load(cls, path: StrPath) -> "Docs":
+        """Open a collection saved with Docs.save.
+
+        Chunks, embeddings and the texts index are memory-mapped, so this takes
+        milliseconds whatever the size of the collection. They are read from
+        disk as they are used.
+        """
+        path = Path(path)
+        with open(path / "catalog.pkl", "rb") as f:
+            catalog = pickle.load(f)
+        if catalog["version"] != STORAGE_VERSION:
+            raise ValueError(
+                f"Cannot load {path}, it was saved in format version "
+                f"{catalog['version']} but version {STORAGE_VERSION} is expected."
+            )
+        state = catalog["state"]
+        # collections saved before caches were left out still have them
+        cls._empty_runtime_state(state)
+        # fill in fields added since the collection was saved
+        for name, field in cls.__fields__.items():
+            if name not in state:
+                state[name] = field.get_default()
+        docs = cls.__new__(cls)
+        object.__setattr__(docs, "__dict__", state)
+        object.__setattr__(docs, "__fields_set__", catalog["fields_set"])
+        docs._init_private_attributes()
+        doc_list = [docs.docs[dockey] for dockey in catalog["dockeys"]]
+        texts = StringColumn(path / "text.bin")
+        names = StringColumn(path / "name.bin")
+        text_docs = np.load(path / "text_doc.npy", mmap_mode="r")
+        ids = np.load(path / "text_ids.npy", mmap_mode="r")
+
+        def load_texts() -> List[Text]:
+            return [
+                Text.construct(
+                    text=texts[i], name=names[i], doc=doc_list[text_docs[i]], row=i
+                )
+                for i in range(len(texts))
+            ]
+
+        docs.texts = LazyTexts(load_texts, len(texts))  # type: ignore
+        docs.embedding_store = EmbeddingStore.from_matrix(
+            np.load(path / "embeddings.npy", mmap_mode="r")
+        )
+        docs.texts_index = None
+        docs.doc_index = None
+        if (path / "texts_index.faiss").exists():
+            docs.texts_index = IDMapFAISS.load_mapped(
+                path / "texts_index.faiss",
+                docs.embeddings,
+                ColumnarDocstore(texts, names, text_docs, doc_list, ids),
+                SortedIdMap(ids),
+            )
+        if (path / "doc_index.faiss").exists():
+            with open(path / "doc_index.faiss", "rb") as f:
+                docs._load_doc_index(f.read())
+        if (path / "lexical.pkl").exists():
+            docs.inverted_index = InvertedIndex.load(path)
+        return docs
 
     def _build_texts_index(self, keys: Optional[Set[DocKey]] = None):
-        if keys is not None and self.jit_texts_index:
-            del self.texts_index
-            self.texts_index = None
-        if self.texts_index is None:
-            texts = self.texts
-            if keys is not None:
-                texts = [t for t in texts if t.doc.dockey in keys]
-            if len(texts) == 0:
-                return
-            raw_texts = [t.text for t in texts]
-            text_embeddings = [t.embeddings for t in texts]
-            metadatas = [t.dict(exclude={"embeddings", "text"}) for t in texts]
-            self.texts_index = FAISS.from_embeddings(
-                # wow adding list to the zip was tricky
-                text_embeddings=list(zip(raw_texts, text_embeddings)),
+        texts_index = self.texts_index
+        if (
+            keys is not None
+            and self.jit_texts_index
+            and not isinstance(texts_index, IDMapFAISS)
+        ):
+            # we can only filter our own index by dockey, so replace this one
+            texts_index = None
+        texts = self.texts
+        if texts_index is None and len(texts) > 0:
+            # built once over all texts - dockey filters are applied at search time
+            rows = [t.row for t in texts]
+            if rows == list(range(len(rows))):
+                # the usual case, when nothing was deleted since compacting
+                # (rows may have been added since this snapshot, so slice)
+                vectors = self.embedding_store.matrix[: len(rows)]
+            else:
+                vectors = self.embedding_store[rows]
+            texts_index = IDMapFAISS.from_vectors(
+                [t.text for t in texts],
+                vectors,
                 embedding=self.embeddings,
-                metadatas=metadatas,
+                metadatas=[self._text_metadata(t) for t in texts],
+                ids=self._text_ids(texts),
             )
+        if texts_index is not self.texts_index:
+            self._share("texts_index", texts_index)
 
     def clear_memory(self):
         """Clear the memory of the model."""
         if self.memory_model is not None:
             self.memory_model.clear()
 
+    def _summary_key(
+        self,
+        answer: Answer,
+        citation: str,
+        name: str,
+        text: str,
+        batched: bool = False,
+    ) -> str:
+        """Key a chunk's summary by everything that goes into making it."""
+        prompt = self.prompts.batch_summary if batched else self.prompts.summary
+        memory = ""
+        if self.memory_model is not None:
+            memory = str(self.memory_model.load_memory_variables({})["memory"])
+        return SummaryCache.make_key(
+            prompt=prompt.template,
+            system_prompt=self.prompts.system,
+            memory=memory,
+            llm=get_llm_id(cast(BaseLanguageModel, self.summary_llm)),
+            question=answer.question,
+            summary_length=answer.summary_length,
+            citation=citation,
+            name=name,
+            text=text,
+        )
+
+    async def _abatch_summarize(
+        self,
+        answer: Answer,
+        matches: List[Document],
+        detailed_citations: bool,
+        get_callbacks: CallbackFactory,
+    ) -> Dict[int, str]:
+        """Summarize chunks several at a time, returning summaries by match index.
+
+        Chunks are packed into requests of up to summary_batch_tokens (estimated
+        at 4 characters per token). Summaries look like those of the summary
+        prompt, ending with their score. Chunks missing from a reply are left
+        out, to be summarized one at a time.
+        """
+        # chunk names need not be unique, so summaries go by position in matches
+        summaries: Dict[int, str] = {}
+        packs: List[List[Tuple[int, Document, str, str]]] = []
+        pack_tokens = 0
+        for index, match in enumerate(matches):
+            name = match.metadata["name"]
+            citation = match.metadata["doc"]["citation"]
+            if detailed_citations:
+                citation = name + ": " + citation
+            key = self._summary_key(
+                answer, citation, name, match.page_content, batched=True
+            )
+            if self.summary_cache is not None:
+                # it may also have been summarized on its own before
+                summary = self.summary_cache.get(key) or self.summary_cache.get(
+                    self._summary_key(answer, citation, name, match.page_content)
+                )
+                if summary is not None:
+                    summaries[index] = summary
+                    continue
+            tokens = (len(match.page_content) + len(citation)) // 4
+            if len(packs) == 0 or pack_tokens + tokens > self.summary_batch_tokens:
+                packs.append([])
+                pack_tokens = 0
+            packs[-1].append((index, match, citation, key))
+            pack_tokens += tokens
+
+        chain = make_chain(
+            self.prompts.batch_summary,
+            cast(BaseLanguageModel, self.summary_llm),
+            memory=self.memory_model,
+            system_prompt=self.prompts.system,
+        )
+
+        async def summarize(pack: List[Tuple[int, Document, str, str]]) -> None:
+            texts = "\n\n".join(
+                f"Excerpt {i + 1} from {citation}:\n{match.page_content}"
+                for i, (_, match, citation, _) in enumerate(pack)
+            )
+            try:
+                output = await arun_chain(
+                    chain,
+                    question=answer.question,
+                    summary_length=answer.summary_length,
+                    texts=texts,
+                    callbacks=get_callbacks("evidence:batch"),
+                )
+            except Exception as e:
+                if guess_is_4xx(str(e)):
+                    return
+                raise e
+            for i, summary in parse_batch_summaries(output, len(pack)).items():
+                index, _, _, key = pack[i]
+                summaries[index] = summary
+                if self.summary_cache is not None:
+                    self.summary_cache.set(key, summary)
+
+        await gather_with_concurrency(
+            self.max_concurrent, *[summarize(p) for p in packs]
+        )
+        return summaries
+
+    def _retrieve(
+        self,
+        answer: Answer,
+        k: int,
+        marginal_relevance: bool,
+        matches: Optional[List[Document]] = None,
+    ) -> Optional[List[Document]]:
+        """Search for the chunks most relevant to the question, if there is an index."""
+        self._build_texts_index(keys=answer.dockey_filter)
+        if self.texts_index is None:
+            return None
+        self.texts_index = cast(VectorStore, self.texts_index)
+        _k = k
+        search_kwargs = {}
+        if answer.dockey_filter is not None:
+            if isinstance(self.texts_index, IDMapFAISS) and self.text_id_ranges:
+                # search only the filtered documents' vectors
+                search_kwargs["id_ranges"] = [
+                    self.text_id_ranges[key]
+                    for key in answer.dockey_filter
+                    if key in self.text_id_ranges
+                ]
+            else:
+                _k = k * 10  # heuristic
+        if matches is not None:
+            # already retrieved, filtered below like search results
+            pass
+        elif isinstance(self.texts_index, IDMapFAISS):
+            # our indexes use self.embeddings, so the question is only embedded once
+            embedding = self._question_embedding(answer)
+            if marginal_relevance:
+                matches = self.texts_index.max_marginal_relevance_search_by_vector(
+                    embedding, k=_k, fetch_k=5 * _k, **search_kwargs
+                )
+            else:
+                matches = self.texts_index.similarity_search_by_vector(
+                    embedding, k=_k, fetch_k=5 * _k, **search_kwargs
+                )
+        elif marginal_relevance:
+            matches = self.texts_index.max_marginal_relevance_search(
+                answer.question, k=_k, fetch_k=5 * _k, **search_kwargs
+            )
+        else:
+            matches = self.texts_index.similarity_search(
+                answer.question, k=_k, fetch_k=5 * _k, **search_kwargs
+            )
+        # only our own index can look up chunks by id
+        if self.hybrid_search and isinstance(self.texts_index, IDMapFAISS):
+            hits = self._get_inverted_index().search(
+                answer.question, _k, id_ranges=search_kwargs.get("id_ranges")
+            )
+            matches = reciprocal_rank_fusion(
+                [matches, self.texts_index.get_by_ids(i for i, _ in hits)],
+                # names are not unique, ids are
+                key=lambda m: m.metadata["id"],
+            )
+        return matches
+
     def get_evidence(
         self,
         answer: Answer,
@@ -398,17 +1465,7 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
         disable_vector_search: bool = False,
         disable_summarization: bool = False,
     ) -> Answer:
-        # special case for jupyter notebooks
-        if "get_ipython" in globals() or "google.colab" in sys.modules:
-            import nest_asyncio
-
-            nest_asyncio.apply()
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        return loop.run_until_complete(
+        return run_sync(
             self.aget_evidence(
                 answer,
                 k=k,
@@ -421,6 +1478,7 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
             )
         )
 
+    @_on_snapshot
     async def aget_evidence(
         self,
         answer: Answer,
@@ -431,26 +1489,30 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
         detailed_citations: bool = False,
         disable_vector_search: bool = False,
         disable_summarization: bool = False,
+        matches: Optional[List[Document]] = None,
+        on_context: Optional[Callable[[Context], None]] = None,
     ) -> Answer:
+        """Gather evidence for the question from the most relevant chunks.
+
+        matches are chunks already retrieved for the question (see
+        aquery_many), searched for without a dockey filter, to use instead of
+        searching the index. on_context, if given, is called with each Context
+        as soon as it is accepted, before the best max_sources are kept.
+        """
         if disable_vector_search:
             k = k * 10000
         if len(self.docs) == 0 and self.doc_index is None:
             return answer
-        self._build_texts_index(keys=answer.dockey_filter)
-        if self.texts_index is None:
+        # embedding the question and searching block, so they run in a thread
+        found = await asyncio.get_running_loop().run_in_executor(
+            None,
+            functools.partial(
+                self._retrieve, answer, k, marginal_relevance, matches=matches
+            ),
+        )
+        if found is None:
             return answer
-        self.texts_index = cast(VectorStore, self.texts_index)
-        _k = k
-        if answer.dockey_filter is not None:
-            _k = k * 10  # heuristic
-        if marginal_relevance:
-            matches = self.texts_index.max_marginal_relevance_search(
-                answer.question, k=_k, fetch_k=5 * _k
-            )
-        else:
-            matches = self.texts_index.similarity_search(
-                answer.question, k=_k, fetch_k=5 * _k
-            )
+        matches = found
         # ok now filter
         if answer.dockey_filter is not None:
             matches = [
@@ -473,14 +1535,26 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
         # now finally cut down
         matches = matches[:k]
 
-        async def process(match):
+        # drop chunks that share (almost) no words with the question, unsummarized
+        if self.prefilter is not None and len(matches) > 0:
+            scores = bm25_scores(answer.question, [m.page_content for m in matches])
+            # without any overlap, the question may just be worded differently
+            if max(scores) > 0:
+                cutoff = max(self.prefilter * max(scores), 1e-9)
+                kept = [m for m, s in zip(matches, scores) if s >= cutoff]
+                answer.pruned += len(matches) - len(kept)
+                matches = kept
+
+        # one chain for all chunks
+        summary_chain = make_chain(
+            self.prompts.summary,
+            cast(BaseLanguageModel, self.summary_llm),
+            memory=self.memory_model,
+            system_prompt=self.prompts.system,
+        )
+
+        async def process(match, summary: Optional[str] = None):
             callbacks = get_callbacks("evidence:" + match.metadata["name"])
-            summary_chain = make_chain(
-                self.prompts.summary,
-                self.summary_llm,
-                memory=self.memory_model,
-                system_prompt=self.prompts.system,
-            )
             # This is dangerous because it
             # could mask errors that are important- like auth errors
             # I also cannot know what the exception
@@ -493,15 +1567,27 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
                     citation = match.metadata["name"] + ": " + citation
                 if self.prompts.skip_summary:
                     context = match.page_content
+                elif summary is not None:
+                    context = summary
                 else:
-                    context = await summary_chain.arun(
-                        question=answer.question,
-                        # Add name so chunk is stated
-                        citation=citation,
-                        summary_length=answer.summary_length,
-                        text=match.page_content,
-                        callbacks=callbacks,
-                    )
+                    context = None
+                    if self.summary_cache is not None:
+                        key = self._summary_key(
+                            answer, citation, match.metadata["name"], match.page_content
+                        )
+                        context = self.summary_cache.get(key)
+                    if context is None:
+                        context = await arun_chain(
+                            summary_chain,
+                            question=answer.question,
+                            # Add name so chunk is stated
+                            citation=citation,
+                            summary_length=answer.summary_length,
+                            text=match.page_content,
+                            callbacks=callbacks,
+                        )
+                        if self.summary_cache is not None:
+                            self.summary_cache.set(key, context)
             except Exception as e:
                 if guess_is_4xx(str(e)):
                     return None
@@ -520,6 +1606,8 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
                 ),
                 score=get_score(context),
             )
+            if on_context is not None:
+                on_context(c)
             return c
 
         if disable_summarization:
@@ -535,11 +1623,35 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
                 )
                 for match in matches
             ]
+            if on_context is not None:
+                for c in contexts:
+                    on_context(c)
 
         else:
-            results = await gather_with_concurrency(
-                self.max_concurrent, *[process(m) for m in matches]
-            )
+            summaries: Dict[int, str] = {}
+            if self.batch_summaries and not self.prompts.skip_summary:
+                summaries = await self._abatch_summarize(
+                    answer, matches, detailed_citations, get_callbacks
+                )
+            coros = [process(m, summaries.get(i)) for i, m in enumerate(matches)]
+            if self.early_exit_score is None and self.evidence_timeout is None:
+                results = await gather_with_concurrency(self.max_concurrent, *coros)
+            else:
+                min_score = self.early_exit_score
+
+                def enough(results: List[Optional[Context]]) -> bool:
+                    if min_score is None:
+                        return False
+                    good = [
+                        c
+                        for c in results + answer.contexts
+                        if c is not None and c.score >= min_score
+                    ]
+                    return len(good) >= max_sources
+
+                results = await gather_until(
+                    self.max_concurrent, coros, enough, timeout=self.evidence_timeout
+                )
             # filter out failures
             contexts = [c for c in results if c is not None]
 
@@ -571,17 +1683,7 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
         key_filter: Optional[bool] = None,
         get_callbacks: CallbackFactory = lambda x: None,
     ) -> Answer:
-        # special case for jupyter notebooks
-        if "get_ipython" in globals() or "google.colab" in sys.modules:
-            import nest_asyncio
-
-            nest_asyncio.apply()
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        return loop.run_until_complete(
+        return run_sync(
             self.aquery(
                 query,
                 k=k,
@@ -605,42 +1707,269 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
         key_filter: Optional[bool] = None,
         get_callbacks: CallbackFactory = lambda x: None,
     ) -> Answer:
+        async for event in self.aquery_stream(
+            query,
+            k=k,
+            max_sources=max_sources,
+            length_prompt=length_prompt,
+            marginal_relevance=marginal_relevance,
+            answer=answer,
+            key_filter=key_filter,
+            get_callbacks=get_callbacks,
+        ):
+            pass
+        return cast(Answer, event)
+
+    def query_many(
+        self,
+        queries: List[str],
+        k: int = 10,
+        max_sources: int = 5,
+        length_prompt="about 100 words",
+        marginal_relevance: bool = True,
+        key_filter: Optional[bool] = None,
+        get_callbacks: CallbackFactory = lambda x: None,
+    ) -> List[Answer]:
+        return run_sync(
+            self.aquery_many(
+                queries,
+                k=k,
+                max_sources=max_sources,
+                length_prompt=length_prompt,
+                marginal_relevance=marginal_relevance,
+                key_filter=key_filter,
+                get_callbacks=get_callbacks,
+            )
+        )
+
+    @_on_snapshot
+    async def aquery_many(
+        self,
+        queries: List[str],
+        k: int = 10,
+        max_sources: int = 5,
+        length_prompt: str = "about 100 words",
+        marginal_relevance: bool = True,
+        key_filter: Optional[bool] = None,
+        get_callbacks: CallbackFactory = lambda x: None,
+    ) -> List[Answer]:
+        """Answer many queries like aquery, sharing work between them.
+
+        The questions are embedded concurrently, like single questions and
+        with the same cache, and unless documents are matched first (see
+        key_filter) the index is searched for all of them at once. A question
+        asked more than once is answered once. The queries run together, so
+        how many requests are made at a time is set by each model's
+        process-wide limiter (see limiter.py), not by the number of questions.
+        With memory, each answer depends on the ones before, so the queries are
+        answered one after another. Answers are in order of queries.
+        """
+        if k < max_sources:
+            raise ValueError("k should be greater than max_sources")
+        unique = (
+            queries if self.memory_model is not None else list(dict.fromkeys(queries))
+        )
+        if len(unique) == 0:
+            return []
+        # the same heuristic as aquery_stream for when documents are matched first
+        doc_match = key_filter or (key_filter is None and len(self.docs) > k)
+
+        embeddings = await self._aembed_queries(unique)
+
+        def search() -> List[Optional[List[Document]]]:
+            matches: List[Optional[List[Document]]] = [None] * len(unique)
+            if not doc_match:
+                self._build_texts_index()
+                if isinstance(self.texts_index, IDMapFAISS):
+                    matches = list(
+                        self.texts_index.search_many_by_vectors(
+                            embeddings,
+                            k=k,
+                            fetch_k=5 * k,
+                            marginal_relevance=marginal_relevance,
+                        )
+                    )
+            return matches
+
+        # searching blocks, so it runs in a thread
+        matches = await asyncio.get_running_loop().run_in_executor(None, search)
+
+        async def run(
+            query: str, embedding: List[float], found: Optional[List[Document]]
+        ) -> Answer:
+            async for event in self.aquery_stream(
+                query,
+                k=k,
+                max_sources=max_sources,
+                length_prompt=length_prompt,
+                marginal_relevance=marginal_relevance,
+                key_filter=key_filter,
+                get_callbacks=get_callbacks,
+                question_embedding=embedding,
+                matches=found,
+            ):
+                pass
+            return cast(Answer, event)
+
+        if self.memory_model is not None:
+            return [await run(*args) for args in zip(unique, embeddings, matches)]
+        answers = dict(
+            zip(
+                unique,
+                await asyncio.gather(
+                    *[run(*args) for args in zip(unique, embeddings, matches)]
+                ),
+            )
+        )
+        results = []
+        seen = set()
+        for query in queries:
+            # repeated questions get their own copy
+            answer = answers[query]
+            results.append(answer.copy(deep=True) if query in seen else answer)
+            seen.add(query)
+        return results
+
+    @_on_snapshot
+    async def aquery_stream(
+        self,
+        query: str,
+        k: int = 10,
+        max_sources: int = 5,
+        length_prompt: str = "about 100 words",
+        marginal_relevance: bool = True,
+        answer: Optional[Answer] = None,
+        key_filter: Optional[bool] = None,
+        get_callbacks: CallbackFactory = lambda x: None,
+        question_embedding: Optional[List[float]] = None,
+        matches: Optional[List[Document]] = None,
+    ) -> AsyncIterator[Union[Context, str, Answer]]:
+        """Answer a query like aquery, yielding results as they become available.
+
+        Yields each Context as it is accepted as evidence (the Answer keeps the
+        best max_sources of them), then the answer as it is written
+        (tokens if the llm streams, e.g. ChatOpenAI(streaming=True), otherwise
+        all at once) and finally the Answer, with references. With a post
+        prompt, the final Answer has the post-processed text instead.
+
+        question_embedding and matches, if already known (see aquery_many),
+        are used instead of embedding the question and searching for chunks.
+        """
         if k < max_sources:
             raise ValueError("k should be greater than max_sources")
+        start = time.perf_counter()
+        answer_key = None
         if answer is None:
-            answer = Answer(question=query, answer_length=length_prompt)
-        if len(answer.contexts) == 0:
+            answer = Answer(
+                question=query,
+                answer_length=length_prompt,
+                question_embedding=question_embedding,
+            )
+            # with memory, answers depend on the conversation so are not reused
+            if self.answer_cache is not None and self.memory_model is None:
+                answer_key = make_cache_key(
+                    k=k,
+                    max_sources=max_sources,
+                    length_prompt=length_prompt,
+                    marginal_relevance=marginal_relevance,
+                    key_filter=key_filter,
+                    llm=get_llm_id(cast(BaseLanguageModel, self.llm)),
+                    summary_llm=get_llm_id(cast(BaseLanguageModel, self.summary_llm)),
+                    embeddings=get_embedding_name(self.embeddings),
+                    prompts=self.prompts.json(),
+                )
+                # answers are only reused while the documents are unchanged
+                generation = self.generation
+                cached = self.answer_cache.get(
+                    await self._aquestion_embedding(answer), answer_key, generation
+                )
+                if cached is not None:
+                    answer = self._reword_answer(cached, query)
+                    answer.timings = {"total": time.perf_counter() - start}
+                    for c in answer.contexts:
+                        yield c
+                    yield answer.answer
+                    yield answer
+                    return
+        # stages run as soon as what they need is ready: the pre prompt only
+        # needs the question, so it runs while evidence is gathered
+        timings = answer.timings
+
+        async def gather_evidence(
+            answer: Answer, on_context: Callable[[Context], None]
+        ) -> Answer:
             # this is heuristic - k and len(docs) are not
             # comparable - one is chunks and one is docs
             if key_filter or (key_filter is None and len(self.docs) > k):
-                keys = await self.adoc_match(
-                    answer.question, get_callbacks=get_callbacks
-                )
+                query_embedding = None
+                if isinstance(self.doc_index, IDMapFAISS):
+                    query_embedding = await self._aquestion_embedding(answer)
+                with record_time(timings, "doc_match"):
+                    keys = await self.adoc_match(
+                        answer.question,
+                        get_callbacks=get_callbacks,
+                        query_embedding=query_embedding,
+                    )
                 if len(keys) > 0:
                     answer.dockey_filter = keys
-            answer = await self.aget_evidence(
-                answer,
-                k=k,
-                max_sources=max_sources,
-                marginal_relevance=marginal_relevance,
-                get_callbacks=get_callbacks,
-            )
-        if self.prompts.pre is not None:
+            with record_time(timings, "evidence"):
+                return await self.aget_evidence(
+                    answer,
+                    k=k,
+                    max_sources=max_sources,
+                    marginal_relevance=marginal_relevance,
+                    get_callbacks=get_callbacks,
+                    matches=matches if answer.dockey_filter is None else None,
+                    on_context=on_context,
+                )
+
+        async def pre(prompt: PromptTemplate) -> str:
             chain = make_chain(
-                self.prompts.pre,
+                prompt,
                 cast(BaseLanguageModel, self.llm),
                 memory=self.memory_model,
                 system_prompt=self.prompts.system,
             )
-            pre = await chain.arun(
-                question=answer.question, callbacks=get_callbacks("pre")
-            )
-            answer.context = answer.context + "\n\nExtra background information:" + pre
+            with record_time(timings, "pre"):
+                return await arun_chain(
+                    chain, question=answer.question, callbacks=get_callbacks("pre")
+                )
+
+        pre_task = None
+        if self.prompts.pre is not None:
+            pre_task = asyncio.ensure_future(pre(self.prompts.pre))
+        try:
+            if len(answer.contexts) == 0:
+                # contexts are yielded as their summaries complete
+                contexts: asyncio.Queue = asyncio.Queue()
+                evidence_task = asyncio.ensure_future(
+                    gather_evidence(answer, contexts.put_nowait)
+                )
+                try:
+                    async for c in iter_queue(evidence_task, contexts):
+                        yield c
+                finally:
+                    # the caller stopped early
+                    evidence_task.cancel()
+                answer = evidence_task.result()
+            else:
+                for c in answer.contexts:
+                    yield c
+            if pre_task is not None:
+                answer.context = (
+                    answer.context
+                    + "\n\nExtra background information:"
+                    + await pre_task
+                )
+        finally:
+            if pre_task is not None:
+                pre_task.cancel()
         bib = dict()
         if len(answer.context) < 10 and not self.memory:
             answer_text = (
                 "I cannot answer this question due to insufficient information."
             )
+            yield answer_text
         else:
             callbacks = get_callbacks("answer")
             qa_chain = make_chain(
@@ -649,13 +1978,30 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
                 memory=self.memory_model,
                 system_prompt=self.prompts.system,
             )
-            answer_text = await qa_chain.arun(
-                context=answer.context,
-                answer_length=answer.answer_length,
-                question=answer.question,
-                callbacks=callbacks,
-                verbose=True,
+            tokens: asyncio.Queue = asyncio.Queue()
+            qa_task = asyncio.ensure_future(
+                arun_chain(
+                    qa_chain,
+                    context=answer.context,
+                    answer_length=answer.answer_length,
+                    question=answer.question,
+                    callbacks=[*(callbacks or []), TokenQueueHandler(tokens)],
+                    verbose=True,
+                )
             )
+            streamed = False
+            qa_start = time.perf_counter()
+            try:
+                async for token in iter_queue(qa_task, tokens):
+                    streamed = True
+                    yield token
+            finally:
+                # the caller stopped early
+                qa_task.cancel()
+            timings["answer"] = time.perf_counter() - qa_start
+            answer_text = qa_task.result()
+            if not streamed:
+                yield answer_text
         # it still happens
         if "(Example2012)" in answer_text:
             answer_text = answer_text.replace("(Example2012)", "")
@@ -682,7 +2028,10 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
                 memory=self.memory_model,
                 system_prompt=self.prompts.system,
             )
-            post = await chain.arun(**answer.dict(), callbacks=get_callbacks("post"))
+            with record_time(timings, "post"):
+                post = await arun_chain(
+                    chain, **answer.dict(), callbacks=get_callbacks("post")
+                )
             answer.answer = post
             answer.formatted_answer = f"Question: {answer.question}\n\n{post}\n"
             if len(bib) > 0:
@@ -692,5 +2041,26 @@ class Docs(BaseModel, arbitrary_types_allowed=True, smart_union=True):
             self.memory_model.save_context(
                 {"Question": answer.question}, {"Answer": answer.answer}
             )
+        if answer_key is not None:
+            self.answer_cache.set(  # type: ignore
+                self._question_embedding(answer),
+                answer_key,
+                generation,
+                answer.copy(deep=True),
+            )
 
+        timings["total"] = time.perf_counter() - start
+        yield answer
+
+    @staticmethod
+    def _reword_answer(answer: Answer, question: str) -> Answer:
+        """Copy a cached answer, for a question asked in other words."""
+        old = f"Question: {answer.question}\n\n"
+        answer = answer.copy(deep=True)
+        if answer.formatted_answer.startswith(old):
+            answer.formatted_answer = (
+                f"Question: {question}\n\n" + answer.formatted_answer[len(old) :]
+            )
+        answer.question = question
+        answer.question_embedding = None
         return answer
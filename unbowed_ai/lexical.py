@@ -0,0 +1,359 @@
+"""Lexical relevance scoring: BM25 over chunk words, complementing vector search."""
+import copy
+import math
+import pickle
+import re
+from collections import Counter
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+import numpy as np
+
+T = TypeVar("T")
+
+# words too common in questions to say anything about relevance
+STOPWORDS = frozenset(
+    "a about above after all also an and any are as at be because been before "
+    "being between both but by can could did do does doing during each few for "
+    "from had has have having how i if in into is it its just many may might "
+    "more most much my no nor not of on once only or other our out over own "
+    "same should so some such than that the their them then there these they "
+    "this those through to too under until up very was we were what when where "
+    "which while who whom why will with would you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase words, without stopwords."""
+    return [w for w in re.findall(r"\w\w+", text.lower()) if w not in STOPWORDS]
+
+
+def bm25_scores(
+    query: str, texts: List[str], k1: float = 1.5, b: float = 0.75
+) -> List[float]:
+    """Score each text against the query with BM25, using the texts as the corpus."""
+    docs = [Counter(tokenize(t)) for t in texts]
+    if len(docs) == 0:
+        return []
+    lengths = [sum(d.values()) for d in docs]
+    avg_length = max(sum(lengths) / len(docs), 1)
+    scores = [0.0] * len(docs)
+    for term in set(tokenize(query)):
+        n = sum(term in d for d in docs)
+        if n == 0:
+            continue
+        idf = math.log(1 + (len(docs) - n + 0.5) / (n + 0.5))
+        for i, (d, length) in enumerate(zip(docs, lengths)):
+            tf = d[term]
+            if tf:
+                scores[i] += (
+                    idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_length))
+                )
+    return scores
+
+
+class Postings(NamedTuple):
+    """Postings sorted by term, with term t's at offsets[t]:offsets[t + 1]."""
+
+    offsets: np.ndarray
+    ids: np.ndarray
+    tfs: np.ndarray
+    lengths: np.ndarray
+
+    @classmethod
+    def build(
+        cls,
+        terms: np.ndarray,
+        ids: np.ndarray,
+        tfs: np.ndarray,
+        lengths: np.ndarray,
+        n_terms: int,
+    ) -> "Postings":
+        order = np.lexsort((ids, terms))
+        offsets = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=n_terms), out=offsets[1:])
+        return cls(offsets, ids[order], tfs[order], lengths[order])
+
+    @classmethod
+    def merge(cls, parts: List["Postings"], n_terms: int) -> "Postings":
+        """Merge postings, keeping them sorted by term without sorting again."""
+        offsets = [
+            np.pad(p.offsets, (0, n_terms + 1 - len(p.offsets)), mode="edge")
+            for p in parts
+        ]
+        counts = [np.diff(o) for o in offsets]
+        merged = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(sum(counts), out=merged[1:])
+        # where the next posting of each term goes
+        position = merged[:-1].copy()
+        size = int(merged[-1])
+        ids = np.empty(size, dtype=np.int64)
+        tfs = np.empty(size, dtype=np.float32)
+        lengths = np.empty(size, dtype=np.float32)
+        for p, o, c in zip(parts, offsets, counts):
+            terms = p.terms()
+            dest = position[terms] + np.arange(len(p)) - o[terms]
+            ids[dest] = p.ids
+            tfs[dest] = p.tfs
+            lengths[dest] = p.lengths
+            position += c
+        return cls(merged, ids, tfs, lengths)
+
+    def without(self, ids: np.ndarray) -> "Postings":
+        """These postings, except those of the given ids."""
+        keep = ~np.isin(self.ids, ids)
+        offsets = np.zeros_like(self.offsets)
+        counts = np.bincount(self.terms()[keep], minlength=len(self.offsets) - 1)
+        np.cumsum(counts, out=offsets[1:])
+        return Postings(offsets, self.ids[keep], self.tfs[keep], self.lengths[keep])
+
+    @classmethod
+    def empty(cls) -> "Postings":
+        return cls(
+            np.zeros(1, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.float32),
+            np.empty(0, dtype=np.float32),
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def get(self, term: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if term + 1 >= len(self.offsets):
+            # added after these postings were built
+            return self.ids[:0], self.tfs[:0], self.lengths[:0]
+        start, stop = self.offsets[term], self.offsets[term + 1]
+        return self.ids[start:stop], self.tfs[start:stop], self.lengths[start:stop]
+
+    def terms(self) -> np.ndarray:
+        """The term of each posting."""
+        return np.repeat(
+            np.arange(len(self.offsets) - 1, dtype=np.int64), np.diff(self.offsets)
+        )
+
+
+class InvertedIndex:
+    """A BM25 index of the words in chunks, by chunk id.
+
+    Postings (chunk id, term frequency and chunk length, per term) are kept in
+    flat arrays sorted by term. Added chunks go into a second, smaller set of
+    postings, merged into the main one once it grows past a quarter of its
+    size, so adding is cheap and searching only ever looks in two places.
+    Deleted chunks are skipped until compact.
+
+    Terms in more than max_df of (over a thousand) chunks say little about
+    relevance and would dominate search time, so they are not scored.
+    """
+
+    # saved files, besides the vocabulary and totals
+    _ARRAYS = ["offsets", "ids", "tfs", "lengths"]
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, max_df: float = 0.1):
+        self.k1 = k1
+        self.b = b
+        self.max_df = max_df
+        self.vocabulary: Dict[str, int] = {}
+        self.main = Postings.empty()
+        self.new = Postings.empty()
+        self.doc_ids = np.empty(0, dtype=np.int64)
+        self.doc_lengths = np.empty(0, dtype=np.float32)
+        self.deleted: Set[int] = set()
+        self.n_docs = 0
+        self.total_length = 0.0
+
+    def __len__(self) -> int:
+        """The number of (not deleted) chunks."""
+        return self.n_docs
+
+    @property
+    def deleted_fraction(self) -> float:
+        return len(self.deleted) / max(len(self.doc_ids), 1)
+
+    def copy(self) -> "InvertedIndex":
+        """Copy the index, so the copy can be changed while this one is searched.
+
+        Changes replace the postings arrays rather than writing to them, so
+        those are shared.
+        """
+        index = copy.copy(self)
+        index.vocabulary = dict(self.vocabulary)
+        index.deleted = set(self.deleted)
+        return index
+
+    def add(self, ids: Sequence[int], texts: Sequence[str]) -> None:
+        vocabulary = self.vocabulary
+        terms: List[int] = []
+        tfs: List[int] = []
+        n_terms = []
+        doc_lengths = []
+        for text in texts:
+            counts = Counter(tokenize(text))
+            for word in counts:
+                if word not in vocabulary:
+                    vocabulary[word] = len(vocabulary)
+            terms.extend(vocabulary[w] for w in counts)
+            tfs.extend(counts.values())
+            n_terms.append(len(counts))
+            doc_lengths.append(sum(counts.values()))
+        new_ids = np.array(ids, dtype=np.int64)
+        new_lengths = np.array(doc_lengths, dtype=np.float32)
+        n_vocabulary = len(vocabulary)
+        added = Postings.build(
+            np.array(terms, dtype=np.int64),
+            np.repeat(new_ids, n_terms),
+            np.array(tfs, dtype=np.float32),
+            np.repeat(new_lengths, n_terms),
+            n_vocabulary,
+        )
+        self.new = Postings.merge([self.new, added], n_vocabulary)
+        self.doc_ids = np.concatenate([self.doc_ids, new_ids])
+        self.doc_lengths = np.concatenate([self.doc_lengths, new_lengths])
+        if np.any(np.diff(self.doc_ids) < 0):
+            # kept sorted, to look up lengths when deleting
+            order = np.argsort(self.doc_ids, kind="stable")
+            self.doc_ids = self.doc_ids[order]
+            self.doc_lengths = self.doc_lengths[order]
+        self.n_docs += len(doc_lengths)
+        self.total_length += float(new_lengths.sum())
+        if len(self.new) > len(self.main) / 4:
+            self._merge()
+
+    def delete(self, ids: Iterable[int]) -> None:
+        ids = [i for i in ids if i not in self.deleted]
+        positions = np.searchsorted(self.doc_ids, ids)
+        for i, pos in zip(ids, positions):
+            if pos < len(self.doc_ids) and self.doc_ids[pos] == i:
+                self.deleted.add(i)
+                self.n_docs -= 1
+                self.total_length -= float(self.doc_lengths[pos])
+
+    def _merge(self) -> None:
+        """Merge all postings into main, dropping deleted chunks."""
+        parts = [self.main, self.new]
+        if self.deleted:
+            deleted = np.fromiter(self.deleted, dtype=np.int64)
+            parts = [p.without(deleted) for p in parts]
+            keep = ~np.isin(self.doc_ids, deleted)
+            self.doc_ids = self.doc_ids[keep]
+            self.doc_lengths = self.doc_lengths[keep]
+            self.deleted = set()
+        self.main = Postings.merge(parts, len(self.vocabulary))
+        self.new = Postings.empty()
+
+    def compact(self) -> None:
+        if self.deleted or len(self.new) > 0:
+            self._merge()
+
+    def search(
+        self,
+        query: str,
+        k: int,
+        id_ranges: Optional[List[Tuple[int, int]]] = None,
+    ) -> List[Tuple[int, float]]:
+        """Return the ids and BM25 scores of the k chunks best matching the query.
+
+        If id_ranges is given, only chunks with ids in those [start, stop)
+        ranges are returned.
+        """
+        terms = {self.vocabulary[w] for w in tokenize(query) if w in self.vocabulary}
+        if self.n_docs == 0 or len(terms) == 0:
+            return []
+        avg_length = max(self.total_length / self.n_docs, 1.0)
+        # scores are summed over terms in a dense array, indexed by id
+        dense = np.zeros(int(self.doc_ids[-1]) + 1)
+        all_ids = []
+        for term in terms:
+            found = [self.main.get(term), self.new.get(term)]
+            # counts deleted chunks too, until they are compacted away
+            df = sum(len(ids) for ids, _, _ in found)
+            if df > 1000 and df > self.max_df * self.n_docs:
+                continue
+            n = max(self.n_docs, df)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for ids, tfs, lengths in found:
+                norm = self.k1 * (1 - self.b + self.b * lengths / avg_length)
+                # ids are unique within a term's postings
+                dense[ids] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+                all_ids.append(ids)
+        if len(all_ids) == 0:
+            return []
+        ids = np.concatenate(all_ids)
+        if self.deleted:
+            ids = ids[~np.isin(ids, np.fromiter(self.deleted, dtype=np.int64))]
+        if id_ranges is not None:
+            ranges = np.array(sorted(id_ranges), dtype=np.int64).reshape(-1, 2)
+            i = np.searchsorted(ranges[:, 0], ids, side="right") - 1
+            ids = ids[(i >= 0) & (ids < ranges[np.maximum(i, 0), 1])]
+        # ids appear once per matching term, so this many hold the k best
+        n_best = k * len(terms)
+        if len(ids) > n_best:
+            ids = ids[np.argpartition(-dense[ids], n_best)[:n_best]]
+        ids = np.unique(ids)
+        scores = dense[ids]
+        order = np.argsort(-scores, kind="stable")[:k]
+        return [(int(ids[i]), float(scores[i])) for i in order]
+
+    def save(self, path: Path) -> None:
+        """Save to files named lexical* in a directory, see load."""
+        self.compact()
+        for name in self._ARRAYS:
+            np.save(path / f"lexical_{name}.npy", getattr(self.main, name))
+        np.save(path / "lexical_doc_ids.npy", self.doc_ids)
+        np.save(path / "lexical_doc_lengths.npy", self.doc_lengths)
+        with open(path / "lexical.pkl", "wb") as f:
+            pickle.dump(
+                {
+                    "k1": self.k1,
+                    "b": self.b,
+                    "max_df": self.max_df,
+                    "vocabulary": self.vocabulary,
+                    "total_length": self.total_length,
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, path: Path) -> "InvertedIndex":
+        """Open an index saved with save, memory-mapping its postings."""
+        with open(path / "lexical.pkl", "rb") as f:
+            state = pickle.load(f)
+        index = cls(k1=state["k1"], b=state["b"], max_df=state["max_df"])
+        index.vocabulary = state["vocabulary"]
+        index.total_length = state["total_length"]
+        index.main = Postings(
+            *[
+                np.load(path / f"lexical_{name}.npy", mmap_mode="r")
+                for name in cls._ARRAYS
+            ]
+        )
+        index.doc_ids = np.load(path / "lexical_doc_ids.npy", mmap_mode="r")
+        index.doc_lengths = np.load(path / "lexical_doc_lengths.npy", mmap_mode="r")
+        index.n_docs = len(index.doc_ids)
+        return index
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[T]], key: Callable[[T], Hashable], k: int = 60
+) -> List[T]:
+    """Merge rankings of items, scoring each by the sum of 1 / (k + rank)."""
+    scores: Dict[Hashable, float] = {}
+    items: Dict[Hashable, T] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            item_key = key(item)
+            scores[item_key] = scores.get(item_key, 0.0) + 1 / (k + rank + 1)
+            items.setdefault(item_key, item)
+    return [items[i] for i in sorted(scores, key=scores.get, reverse=True)]
@@ -0,0 +1,230 @@
+"""Process-wide adaptive rate limiting of model requests.
+
+Every request to a model goes through the ``AdaptiveLimiter`` for that model
+(see ``get_limiter``), so all Docs in a process share its budget. A limiter
+paces requests with token buckets for requests and tokens per minute, and
+adapts how many requests run at once: it grows by about one per round of
+successful requests and halves when the provider says it is rate limited
+(additive increase, multiplicative decrease). Rate limited requests are
+retried with exponential backoff instead of failing.
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+from langchain.base_language import BaseLanguageModel
+
+T = TypeVar("T")
+
+
+def is_rate_limit_error(e: BaseException) -> bool:
+    """Guess if an exception (from any provider) means we were rate limited."""
+    msg = str(e).lower()
+    return (
+        "429" in msg
+        or "rate limit" in msg
+        or "too many requests" in msg
+        or "ratelimit" in type(e).__name__.lower()
+    )
+
+
+class TokenBucket:
+    """Allows ``per_minute`` of something per minute, in bursts of up to that many.
+
+    Callers reserve what they need up front and wait until the bucket has
+    refilled enough, so waiting callers are served in order.
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Take amount from the bucket, returning how many seconds to wait for it."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.per_minute,
+                self.tokens + (now - self.updated) * self.per_minute / 60,
+            )
+            self.updated = now
+            # a single request larger than the bucket waits for a full bucket
+            self.tokens -= min(amount, self.per_minute)
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens * 60 / self.per_minute
+
+    async def acquire(self, amount: float = 1) -> None:
+        delay = self.reserve(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class AdaptiveLimiter:
+    """Limits the rate and concurrency of requests to one model.
+
+    It is safe to share between threads and event loops.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        concurrency: int = 8,
+        min_concurrency: int = 1,
+        max_concurrency: int = 64,
+        backoff: float = 0.5,
+        max_retries: int = 6,
+        retry_delay: float = 1.0,
+        max_retry_delay: float = 60.0,
+    ):
+        self.requests = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.limit = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.backoff = backoff
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.active = 0
+        self.successes = 0
+        self.rate_limited = 0
+        self._last_backoff = 0.0
+        self._waiters: Deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def concurrency(self) -> int:
+        """How many requests may currently run at once."""
+        return max(self.min_concurrency, int(self.limit))
+
+    def _wake_waiters(self) -> None:
+        # must hold the lock. Slots are handed over, so active stays counted
+        while self._waiters and self.active < self.concurrency:
+            loop, fut = self._waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(self._wake, fut)
+            except RuntimeError:
+                # its event loop has closed
+                continue
+            self.active += 1
+
+    def _wake(self, fut: asyncio.Future) -> None:
+        if fut.cancelled():
+            # the waiter gave up after being handed a slot
+            self._release()
+        else:
+            fut.set_result(None)
+
+    async def _acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.active < self.concurrency and not self._waiters:
+                self.active += 1
+                return
+            fut = loop.create_future()
+            self._waiters.append((loop, fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove((loop, fut))
+                    waiting = True
+                except ValueError:
+                    waiting = False
+            if not waiting and fut.done() and not fut.cancelled():
+                # woken, but cancelled before resuming, so give the slot back
+                # (if it was cancelled before being woken, _wake gives it back)
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        with self._lock:
+            self.active -= 1
+            self._wake_waiters()
+
+    def _on_success(self) -> None:
+        with self._lock:
+            self.successes += 1
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._wake_waiters()
+
+    def _on_rate_limit(self) -> None:
+        with self._lock:
+            self.rate_limited += 1
+            now = time.monotonic()
+            # requests in flight together get rate limited together, so back off once
+            if now - self._last_backoff >= self.retry_delay:
+                self._last_backoff = now
+                self.limit = max(self.min_concurrency, self.limit * self.backoff)
+
+    async def call(self, request: Callable[[], Awaitable[T]], tokens: int = 0) -> T:
+        """Make a request, retrying it while it is rate limited.
+
+        Args:
+            request: makes the request, it is called again for each retry
+            tokens: estimated tokens the request will use, for tokens_per_minute
+        """
+        delay = self.retry_delay
+        attempt = 0
+        while True:
+            await self._acquire()
+            try:
+                if self.requests is not None:
+                    await self.requests.acquire(1)
+                if self.tokens is not None and tokens > 0:
+                    await self.tokens.acquire(tokens)
+                result = await request()
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.max_retries:
+                    raise e
+                self._on_rate_limit()
+            else:
+                self._on_success()
+                return result
+            finally:
+                self._release()
+            attempt += 1
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, self.max_retry_delay)
+
+
+_limiters: Dict[str, AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter_name(llm: BaseLanguageModel) -> str:
+    """Requests are limited per model, whatever the other settings."""
+    for attr in ["model_name", "model", "deployment_name"]:
+        value = getattr(llm, attr, None)
+        if value is not None:
+            return f"{type(llm).__name__}:{value}"
+    return type(llm).__name__
+
+
+def get_limiter(name: str) -> AdaptiveLimiter:
+    """Get the process-wide limiter for a model, see get_limiter_name."""
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveLimiter()
+        return _limiters[name]
+
+
+def set_limiter(name: str, **kwargs: Any) -> AdaptiveLimiter:
+    """Replace the limiter for a model, e.g. with its provider's rate limits.
+
+    >>> set_limiter("ChatOpenAI:gpt-4", requests_per_minute=500, tokens_per_minute=30_000)
+    """
+    limiter = AdaptiveLimiter(**kwargs)
+    with _limiters_lock:
+        _limiters[name] = limiter
+    return limiter
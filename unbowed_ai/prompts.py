@@ -16,6 +16,24 @@ summary_prompt = PromptTemplate(
     "Relevant Information Summary:",
 )
 
+# summarizes several chunks in one request, see Docs.batch_summaries
+batch_summary_prompt = PromptTemplate(
+    input_variables=["texts", "question", "summary_length"],
+    template="Summarize each numbered excerpt below to help answer a question. "
+    "Do not directly answer the question, instead summarize "
+    "to give evidence to help answer the question. "
+    "Focus on specific details, including numbers, equations, or specific quotes. "
+    'Summarize an excerpt as "Not applicable" if it is irrelevant. '
+    "Use {summary_length} for each excerpt and score each from 1-10 "
+    "indicating relevance to question. "
+    "Reply with only a JSON list with one object per excerpt, like "
+    '[{{"excerpt": 1, "summary": "...", "score": 7}}]. Do not explain your scores.'
+    "\n\n"
+    "{texts}\n\n"
+    "Question: {question}\n"
+    "JSON:",
+)
+
 qa_prompt = PromptTemplate(
     input_variables=["context", "answer_length", "question"],
     template="Write an answer ({answer_length}) "
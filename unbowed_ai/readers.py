@@ -1,88 +1,114 @@
+from io import BytesIO, StringIO
 from pathlib import Path
-from typing import List
+from typing import Iterable, Iterator, List, Optional, Union
 
 import pandas as pd
 from html2text import html2text
 from langchain.text_splitter import TokenTextSplitter
 
+from .cache import ParseCache
 from .types import Doc, Text
+from .utils import Buffer, maybe_is_html, maybe_is_pdf, md5sum
 
+# documents can be read from a path or from an in-memory buffer of the file
+DocSource = Union[Path, Buffer]
 
-def parse_pdf_fitz(path: Path, doc: Doc, chunk_chars: int, overlap: int) -> List[Text]:
-    import fitz
 
-    file = fitz.open(path)
+def _is_buffer(path: DocSource) -> bool:
+    return isinstance(path, (bytes, bytearray, memoryview))
+
+
+def _read_text(path: DocSource) -> str:
+    if _is_buffer(path):
+        try:
+            return str(path, "utf-8")
+        except UnicodeDecodeError:
+            return str(path, "utf-8", errors="ignore")
+    try:
+        with open(path) as f:
+            return f.read()
+    except UnicodeDecodeError:
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            return f.read()
+
+
+def _iter_page_chunks(
+    pages: Iterable[str], doc: Doc, chunk_chars: int, overlap: int
+) -> Iterator[Text]:
+    """Chunk a stream of page texts, keeping at most one page plus one chunk in memory."""
     split = ""
-    pages: List[str] = []
-    texts: List[Text] = []
-    for i in range(file.page_count):
-        page = file.load_page(i)
-        split += page.get_text("text", sort=True)
-        pages.append(str(i + 1))
+    first_page = last_page = ""
+    for i, page_text in enumerate(pages):
+        # only the carried over tail (< chunk_chars) is copied, so this is linear
+        split += page_text
+        if first_page == "":
+            first_page = str(i + 1)
+        last_page = str(i + 1)
         # split could be so long it needs to be split
         # into multiple chunks. Or it could be so short
         # that it needs to be combined with the next chunk.
-        while len(split) > chunk_chars:
+        start = 0
+        while len(split) - start > chunk_chars:
             # pretty formatting of pages (e.g. 1-3, 4, 5-7)
-            pg = "-".join([pages[0], pages[-1]])
-            texts.append(
-                Text(
-                    text=split[:chunk_chars], name=f"{doc.docname} pages {pg}", doc=doc
-                )
+            pg = "-".join([first_page, last_page])
+            yield Text(
+                text=split[start : start + chunk_chars],
+                name=f"{doc.docname} pages {pg}",
+                doc=doc,
             )
-            split = split[chunk_chars - overlap :]
-            pages = [str(i + 1)]
+            start += chunk_chars - overlap
+            first_page = last_page
+        split = split[start:]
     if len(split) > overlap:
-        pg = "-".join([pages[0], pages[-1]])
-        texts.append(
-            Text(text=split[:chunk_chars], name=f"{doc.docname} pages {pg}", doc=doc)
+        pg = "-".join([first_page, last_page])
+        yield Text(text=split[:chunk_chars], name=f"{doc.docname} pages {pg}", doc=doc)
+
+
+def iter_pdf_fitz(
+    path: DocSource, doc: Doc, chunk_chars: int, overlap: int
+) -> Iterator[Text]:
+    import fitz
+
+    if _is_buffer(path):
+        file = fitz.open(stream=path, filetype="pdf")
+    else:
+        file = fitz.open(path)
+    try:
+        pages = (
+            file.load_page(i).get_text("text", sort=True)
+            for i in range(file.page_count)
         )
-    file.close()
-    return texts
+        yield from _iter_page_chunks(pages, doc, chunk_chars, overlap)
+    finally:
+        file.close()
 
 
-def parse_pdf(path: Path, doc: Doc, chunk_chars: int, overlap: int) -> List[Text]:
+def iter_pdf(
+    path: DocSource, doc: Doc, chunk_chars: int, overlap: int
+) -> Iterator[Text]:
     import pypdf
 
-    pdfFileObj = open(path, "rb")
-    pdfReader = pypdf.PdfReader(pdfFileObj)
-    split = ""
-    pages: List[str] = []
-    texts: List[Text] = []
-    for i, page in enumerate(pdfReader.pages):
-        split += page.extract_text()
-        pages.append(str(i + 1))
-        # split could be so long it needs to be split
-        # into multiple chunks. Or it could be so short
-        # that it needs to be combined with the next chunk.
-        while len(split) > chunk_chars:
-            # pretty formatting of pages (e.g. 1-3, 4, 5-7)
-            pg = "-".join([pages[0], pages[-1]])
-            texts.append(
-                Text(
-                    text=split[:chunk_chars], name=f"{doc.docname} pages {pg}", doc=doc
-                )
-            )
-            split = split[chunk_chars - overlap :]
-            pages = [str(i + 1)]
-    if len(split) > overlap:
-        pg = "-".join([pages[0], pages[-1]])
-        texts.append(
-            Text(text=split[:chunk_chars], name=f"{doc.docname} pages {pg}", doc=doc)
-        )
-    pdfFileObj.close()
-    return texts
+    # pypdf needs a file-like object, so buffers are wrapped
+    with BytesIO(path) if _is_buffer(path) else open(path, "rb") as pdfFileObj:
+        pdfReader = pypdf.PdfReader(pdfFileObj)
+        pages = (page.extract_text() for page in pdfReader.pages)
+        yield from _iter_page_chunks(pages, doc, chunk_chars, overlap)
+
+
+def parse_pdf_fitz(
+    path: DocSource, doc: Doc, chunk_chars: int, overlap: int
+) -> List[Text]:
+    return list(iter_pdf_fitz(path, doc, chunk_chars, overlap))
+
+
+def parse_pdf(path: DocSource, doc: Doc, chunk_chars: int, overlap: int) -> List[Text]:
+    return list(iter_pdf(path, doc, chunk_chars, overlap))
 
 
 def parse_txt(
-    path: Path, doc: Doc, chunk_chars: int, overlap: int, html: bool = False
+    path: DocSource, doc: Doc, chunk_chars: int, overlap: int, html: bool = False
 ) -> List[Text]:
-    try:
-        with open(path) as f:
-            text = f.read()
-    except UnicodeDecodeError:
-        with open(path, encoding="utf-8", errors="ignore") as f:
-            text = f.read()
+    text = _read_text(path)
     if html:
         text = html2text(text)
     # yo, no idea why but the texts are not split correctly
@@ -95,14 +121,16 @@ def parse_txt(
     return texts
 
 
-def parse_code_txt(path: Path, doc: Doc, chunk_chars: int, overlap: int) -> List[Text]:
+def parse_code_txt(
+    path: DocSource, doc: Doc, chunk_chars: int, overlap: int
+) -> List[Text]:
     """Parse a document into chunks, based on line numbers (for code)."""
 
     split = ""
     texts: List[Text] = []
     last_line = 0
 
-    with open(path) as f:
+    with StringIO(_read_text(path)) if _is_buffer(path) else open(path) as f:
         for i, line in enumerate(f):
             split += line
             if len(split) > chunk_chars:
@@ -219,11 +247,11 @@ def _csv_to_timetable_text(df: pd.DataFrame) -> str:
 
 
 def parse_timetable_csv(
-    path: Path, doc: Doc, chunk_chars: int, overlap: int
+    path: DocSource, doc: Doc, chunk_chars: int, overlap: int
 ) -> List[Text]:
     """Parse a CSV document into chunks representing a timetable for Computer Science."""
 
-    df = pd.read_csv(path)
+    df = pd.read_csv(BytesIO(path) if _is_buffer(path) else path)
     timetable_text = _csv_to_timetable_text(df)
 
     # Check if the timetable text exceeds the chunk size
@@ -251,27 +279,106 @@ def parse_timetable_csv(
     return texts
 
 
-def read_doc(
-    path: Path,
-    doc: Doc,
-    chunk_chars: int = 3000,
-    overlap: int = 100,
-    force_pypdf: bool = False,
-) -> List[Text]:
-    """Parse a document into chunks."""
-    str_path = str(path)
+def get_reader_backend(path: DocSource, force_pypdf: bool = False) -> str:
+    """Return the name of the parser that read_doc will use for a path or buffer.
+
+    Buffers have no file extension, so their type is guessed from the first bytes.
+    """
+    if _is_buffer(path):
+        magic = BytesIO(bytes(path[:4]))
+        if maybe_is_pdf(magic):
+            str_path = ".pdf"
+        elif maybe_is_html(magic):
+            str_path = ".html"
+        else:
+            str_path = ".txt"
+    else:
+        str_path = str(path)
     if str_path.endswith(".pdf"):
         if force_pypdf:
-            return parse_pdf(path, doc, chunk_chars, overlap)
+            return "pypdf"
         try:
-            return parse_pdf_fitz(path, doc, chunk_chars, overlap)
+            import fitz  # noqa: F401
         except ImportError:
-            return parse_pdf(path, doc, chunk_chars, overlap)
+            return "pypdf"
+        return "fitz"
     elif str_path.endswith(".txt"):
-        return parse_txt(path, doc, chunk_chars, overlap)
+        return "txt"
     elif str_path.endswith(".html"):
-        return parse_txt(path, doc, chunk_chars, overlap, html=True)
+        return "html"
     elif str_path.endswith(".csv"):  # Handle CSV files
-        return parse_timetable_csv(path, doc, chunk_chars, overlap)
+        return "csv"
+    return "code"
+
+
+def _iter_doc(
+    path: DocSource, doc: Doc, chunk_chars: int, overlap: int, backend: str
+) -> Iterator[Text]:
+    if backend == "fitz":
+        yield from iter_pdf_fitz(path, doc, chunk_chars, overlap)
+    elif backend == "pypdf":
+        yield from iter_pdf(path, doc, chunk_chars, overlap)
+    elif backend == "txt":
+        yield from parse_txt(path, doc, chunk_chars, overlap)
+    elif backend == "html":
+        yield from parse_txt(path, doc, chunk_chars, overlap, html=True)
+    elif backend == "csv":
+        yield from parse_timetable_csv(path, doc, chunk_chars, overlap)
     else:
-        return parse_code_txt(path, doc, chunk_chars, overlap)
+        yield from parse_code_txt(path, doc, chunk_chars, overlap)
+
+
+def iter_doc(
+    path: DocSource,
+    doc: Doc,
+    chunk_chars: int = 3000,
+    overlap: int = 100,
+    force_pypdf: bool = False,
+    cache: Optional[ParseCache] = None,
+    file_hash: Optional[str] = None,
+) -> Iterator[Text]:
+    """Parse a document into chunks, yielding them as they are made.
+
+    PDFs are streamed page by page, so memory stays flat on long documents.
+    If a cache is given, chunks are looked up by the file's hash (computed if
+    not given) and parsing is skipped entirely on a hit.
+    """
+    backend = get_reader_backend(path, force_pypdf)
+    if cache is None:
+        yield from _iter_doc(path, doc, chunk_chars, overlap, backend)
+        return
+    key = cache.make_key(file_hash or md5sum(path), backend, chunk_chars, overlap)
+    chunks = cache.get(key)
+    if chunks is not None:
+        for n, t in chunks:
+            yield Text(text=t, name=doc.docname + n, doc=doc)
+        return
+    # only the (compact) chunk texts are kept until the whole document is cached
+    parsed = []
+    for text in _iter_doc(path, doc, chunk_chars, overlap, backend):
+        parsed.append((text.name[len(doc.docname) :], text.text))
+        yield text
+    cache.set(key, parsed)
+
+
+def read_doc(
+    path: DocSource,
+    doc: Doc,
+    chunk_chars: int = 3000,
+    overlap: int = 100,
+    force_pypdf: bool = False,
+    cache: Optional[ParseCache] = None,
+    file_hash: Optional[str] = None,
+) -> List[Text]:
+    """Parse a document into chunks."""
+    return list(
+        iter_doc(
+            path,
+            doc,
+            chunk_chars=chunk_chars,
+            overlap=overlap,
+            force_pypdf=force_pypdf,
+            cache=cache,
+            file_hash=file_hash,
+        )
+    )
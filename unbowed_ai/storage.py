@@ -0,0 +1,217 @@
+"""On-disk layout used by Docs.save and Docs.load.
+
+A saved collection is a directory holding:
+
+- ``catalog.pkl``: the format version, the Docs settings and its documents
+- ``text.bin``, ``name.bin`` (+ ``.offsets.npy``): chunk texts and names, as columns
+- ``text_doc.npy`` and ``text_ids.npy``: each chunk's document and stable id
+- ``embeddings.npy``: the embedding matrix, one row per chunk
+- ``texts_index.faiss``: the vector index, if it was built
+- ``lexical*``: the inverted index of chunk words, if there is one (see InvertedIndex)
+
+Everything except the catalog is memory-mapped on load, so opening a
+collection takes about the same time whatever its size and chunks are
+only read from disk when they are used.
+"""
+from collections import UserList
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, MutableMapping, Set, Union
+
+import numpy as np
+from langchain.docstore.base import AddableMixin, Docstore
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+
+from .types import Doc, Text
+
+# bump this when the layout changes, older layouts are refused on load
+STORAGE_VERSION = 1
+
+
+class StringColumn:
+    """A read-only list of strings, stored as concatenated UTF-8 and offsets."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._offsets = np.load(f"{path}.offsets.npy", mmap_mode="r")
+        if self._offsets[-1] == 0:
+            self._data = np.empty(0, dtype=np.uint8)
+        else:
+            self._data = np.memmap(path, dtype=np.uint8, mode="r")
+
+    @staticmethod
+    def write(path: Path, strings: Iterable[str]) -> None:
+        offsets = [0]
+        with open(path, "wb") as f:
+            for s in strings:
+                b = s.encode("utf-8")
+                f.write(b)
+                offsets.append(offsets[-1] + len(b))
+        np.save(f"{path}.offsets.npy", np.array(offsets, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        start, stop = self._offsets[i], self._offsets[i + 1]
+        return bytes(self._data[start:stop]).decode("utf-8")
+
+
+class SortedIdMap(MutableMapping):
+    """An index_to_docstore_id for IDMapFAISS, backed by a sorted array of ids.
+
+    Ids in the array map to their string. Changes are kept on the side, so
+    the (memory-mapped) array is never loaded in full or modified.
+    """
+
+    def __init__(self, ids: np.ndarray):
+        self._ids = ids
+        self._added: Dict[int, str] = {}
+        self._removed: Set[int] = set()
+
+    def _in_ids(self, i: int) -> bool:
+        pos = np.searchsorted(self._ids, i)
+        return pos < len(self._ids) and self._ids[pos] == i and i not in self._removed
+
+    def __getitem__(self, i: int) -> str:
+        if i in self._added:
+            return self._added[i]
+        if self._in_ids(i):
+            return str(i)
+        raise KeyError(i)
+
+    def __setitem__(self, i: int, value: str) -> None:
+        self._added[i] = value
+
+    def __delitem__(self, i: int) -> None:
+        if i in self._added:
+            del self._added[i]
+        elif self._in_ids(i):
+            self._removed.add(i)
+        else:
+            raise KeyError(i)
+
+    def __iter__(self) -> Iterator[int]:
+        for i in self._ids:
+            if int(i) not in self._removed:
+                yield int(i)
+        yield from self._added
+
+    def __len__(self) -> int:
+        return len(self._ids) - len(self._removed) + len(self._added)
+
+    def copy(self) -> "SortedIdMap":
+        id_map = SortedIdMap(self._ids)
+        id_map._added = dict(self._added)
+        id_map._removed = set(self._removed)
+        return id_map
+
+    def __reduce__(self):
+        # pickled as a plain dict, so it does not depend on the saved files
+        return (dict, (dict(self),))
+
+
+class ColumnarDocstore(Docstore, AddableMixin):
+    """A docstore for the chunks of a saved Docs, read from its columns on demand."""
+
+    def __init__(
+        self,
+        texts: StringColumn,
+        names: StringColumn,
+        text_docs: np.ndarray,
+        docs: List[Doc],
+        ids: np.ndarray,
+    ):
+        self.texts = texts
+        self.names = names
+        self.text_docs = text_docs
+        self.docs = docs
+        self.ids = ids
+        self._added: Dict[str, Document] = {}
+        self._removed: Set[str] = set()
+
+    def _position(self, search: str) -> int:
+        if search in self._removed or not search.lstrip("-").isdigit():
+            return -1
+        i = int(search)
+        pos = int(np.searchsorted(self.ids, i))
+        if pos < len(self.ids) and self.ids[pos] == i:
+            return pos
+        return -1
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        self._added.update(texts)
+
+    def delete(self, ids: List) -> None:
+        for _id in ids:
+            if self._added.pop(_id, None) is None:
+                self._removed.add(_id)
+
+    def search(self, search: str) -> Union[str, Document]:
+        if search in self._added:
+            return self._added[search]
+        pos = self._position(search)
+        if pos == -1:
+            return f"ID {search} not found."
+        return Document(
+            page_content=self.texts[pos],
+            metadata={
+                "name": self.names[pos],
+                "doc": self.docs[self.text_docs[pos]].dict(),
+            },
+        )
+
+    def copy(self) -> "ColumnarDocstore":
+        docstore = ColumnarDocstore(
+            self.texts, self.names, self.text_docs, self.docs, self.ids
+        )
+        docstore._added = dict(self._added)
+        docstore._removed = set(self._removed)
+        return docstore
+
+    def __reduce__(self):
+        # pickled as a plain docstore, so it does not depend on the saved files
+        found = {str(int(i)): self.search(str(int(i))) for i in self.ids}
+        documents = {k: d for k, d in found.items() if isinstance(d, Document)}
+        return (InMemoryDocstore, ({**documents, **self._added},))
+
+
+class LazyTexts(UserList):
+    """A list of texts that is only built when first used (other than its length)."""
+
+    def __init__(self, load: Callable[[], List[Text]], length: int):
+        self._load = load
+        self._length = length
+        self._data = None
+
+    @property
+    def data(self) -> List[Text]:  # type: ignore
+        if self._data is None:
+            self._data = self._load()
+        return self._data
+
+    @data.setter
+    def data(self, value: List[Text]) -> None:
+        self._data = value
+
+    def __len__(self) -> int:
+        return self._length if self._data is None else len(self._data)
+
+    # these would otherwise make a LazyTexts of the result
+    def __getitem__(self, i):
+        return self.data[i]
+
+    def __add__(self, other):
+        return self.data + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self.data
+
+    def __mul__(self, n):
+        return self.data * n
+
+    def copy(self):
+        return self.data.copy()
+
+    def __reduce__(self):
+        return (list, (list(self.data),))
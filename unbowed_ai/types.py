@@ -8,13 +8,14 @@ from langchain.callbacks.manager import (
 from langchain.prompts import PromptTemplate
 
 try:
-    from pydantic.v1 import BaseModel, validator
+    from pydantic.v1 import BaseModel, Field, validator
 except ImportError:
-    from pydantic import BaseModel, validator
+    from pydantic import BaseModel, Field, validator
 
 import re
 
 from .prompts import (
+    batch_summary_prompt,
     citation_prompt,
     default_system_prompt,
     qa_prompt,
@@ -38,11 +39,15 @@ class Text(BaseModel):
     text: str
     name: str
     doc: Doc
+    # only set until the text is added to a Docs, which moves it to its embedding_store
     embeddings: Optional[List[float]] = None
+    # row of this text's embedding in the embedding_store of its Docs
+    row: Optional[int] = None
 
 
 class PromptCollection(BaseModel):
     summary: PromptTemplate = summary_prompt
+    batch_summary: PromptTemplate = batch_summary_prompt
     qa: PromptTemplate = qa_prompt
     select: PromptTemplate = select_paper_prompt
     cite: PromptTemplate = citation_prompt
@@ -59,6 +64,16 @@ class PromptCollection(BaseModel):
             )
         return v
 
+    @validator("batch_summary")
+    def check_batch_summary(cls, v: PromptTemplate) -> PromptTemplate:
+        if not set(v.input_variables).issubset(
+            set(batch_summary_prompt.input_variables)
+        ):
+            raise ValueError(
+                f"Batch summary prompt can only have variables: {batch_summary_prompt.input_variables}"
+            )
+        return v
+
     @validator("qa")
     def check_qa(cls, v: PromptTemplate) -> PromptTemplate:
         if not set(v.input_variables).issubset(set(qa_prompt.input_variables)):
@@ -120,6 +135,12 @@ class Answer(BaseModel):
     summary_length: str = "about 100 words"
     answer_length: str = "about 100 words"
     memory: Optional[str] = None
+    # embedding of the question, computed once and used by every search
+    question_embedding: Optional[List[float]] = Field(None, exclude=True)
+    # retrieved chunks dropped by Docs.prefilter without summarizing them
+    pruned: int = 0
+    # seconds spent in each stage of answering, see Docs.aquery
+    timings: Dict[str, float] = {}
     # these two below are for convenience
     # and are not set. But you can set them
     # if you want to use them.
@@ -1,14 +1,34 @@
 import asyncio
 import math
+import os
 import re
 import string
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import BinaryIO, List, Union
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Coroutine,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import pypdf
 from langchain.base_language import BaseLanguageModel
+from langchain.schema.embeddings import Embeddings
 
 StrPath = Union[str, Path]
+Buffer = Union[bytes, bytearray, memoryview]
+T = TypeVar("T")
 
 
 def name_in_text(name: str, text: str) -> bool:
@@ -69,11 +89,32 @@ def count_pdf_pages(file_path: StrPath) -> int:
     return num_pages
 
 
-def md5sum(file_path: StrPath) -> str:
+def md5sum(file_path: Union[StrPath, Buffer]) -> str:
     import hashlib
 
+    if isinstance(file_path, (bytes, bytearray, memoryview)):
+        return hashlib.md5(file_path).hexdigest()
+    h = hashlib.md5()
     with open(file_path, "rb") as f:
-        return hashlib.md5(f.read()).hexdigest()
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def read_and_hash(file: BinaryIO, block_size: int = 1 << 20) -> Tuple[memoryview, str]:
+    """Read a binary stream into memory, computing its md5sum along the way."""
+    import hashlib
+
+    if hasattr(file, "getbuffer"):
+        # in-memory file (e.g. BytesIO) - use its buffer without copying
+        buffer = file.getbuffer()
+        return buffer, hashlib.md5(buffer).hexdigest()
+    h = hashlib.md5()
+    data = bytearray()
+    for block in iter(lambda: file.read(block_size), b""):
+        h.update(block)
+        data += block
+    return memoryview(data), h.hexdigest()
 
 
 async def gather_with_concurrency(n: int, *coros: List) -> List:
@@ -87,6 +128,130 @@ async def gather_with_concurrency(n: int, *coros: List) -> List:
     return await asyncio.gather(*(sem_coro(c) for c in coros))
 
 
+async def gather_until(
+    n: int,
+    coros: List[Coroutine],
+    done: Callable[[List[Any]], bool],
+    timeout: Optional[float] = None,
+) -> List[Any]:
+    """Run coroutines, at most n at a time, until done or timeout.
+
+    Results are collected as they complete and done is called with all of them
+    so far. Once it returns True or timeout seconds have passed, coroutines
+    still running are cancelled and the rest are not started. Returns the
+    results in the order they completed.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    waiting = list(reversed(coros))
+    pending: set = set()
+    results: List[Any] = []
+    try:
+        while waiting or pending:
+            while waiting and len(pending) < n:
+                pending.add(asyncio.ensure_future(waiting.pop()))
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                break
+            finished, pending = await asyncio.wait(
+                pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+            )
+            results.extend(f.result() for f in finished)
+            if done(results):
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+        for coro in waiting:
+            coro.close()
+        if pending:
+            await asyncio.wait(pending)
+    return results
+
+
+async def iter_queue(task: asyncio.Future, queue: asyncio.Queue) -> AsyncIterator[Any]:
+    """Yield items put on queue while task runs, then those left once it is done.
+
+    The task is not cancelled if the caller stops early, so callers do that.
+    """
+    while not task.done():
+        item = asyncio.ensure_future(queue.get())
+        await asyncio.wait([task, item], return_when=asyncio.FIRST_COMPLETED)
+        if item.done():
+            yield item.result()
+        else:
+            item.cancel()
+    while not queue.empty():
+        yield queue.get_nowait()
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """The event loop that runs synchronous calls, started on first use.
+
+    It runs forever in a daemon thread, so coroutines from all threads share
+    it, along with its HTTP connections and the limiters' concurrency.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=loop.run_forever, name="unbowed-ai-loop", daemon=True
+            ).start()
+            _loop = loop
+        return _loop
+
+
+def _forget_loop() -> None:
+    # a forked child has no copy of the loop's thread (and the lock may have
+    # been held by another thread), so it starts a loop of its own on first use
+    global _loop, _loop_lock
+    _loop = None
+    _loop_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_loop)
+
+
+def run_sync(coro: Coroutine[Any, Any, T]) -> T:
+    """Run a coroutine on the background loop (see get_loop), waiting for its result.
+
+    It can be called from any thread, including one with an event loop of its
+    own running (e.g. in a notebook), but not from a coroutine on the
+    background loop itself, which would wait for itself.
+    """
+    loop = get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coro.close()
+        raise RuntimeError("Await the coroutine instead, on the library's loop.")
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result()
+    except BaseException:
+        # e.g. KeyboardInterrupt while waiting
+        future.cancel()
+        raise
+
+
+@contextmanager
+def record_time(timings: Dict[str, float], name: str) -> Iterator[None]:
+    """Record the seconds spent in the block as timings[name]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
+
+
 def guess_is_4xx(msg: str) -> bool:
     if re.search(r"4\d\d", msg):
         return True
@@ -100,6 +265,26 @@ def get_llm_name(llm: BaseLanguageModel) -> str:
         return llm.model  # type: ignore
 
 
+def get_llm_id(llm: BaseLanguageModel) -> str:
+    """Identify an LLM and its sampling settings, e.g. for keying cached outputs."""
+    name = type(llm).__name__
+    for attr in ["model_name", "model", "deployment_name", "temperature"]:
+        value = getattr(llm, attr, None)
+        if value is not None:
+            name += f":{value}"
+    return name
+
+
+def get_embedding_name(embeddings: Embeddings) -> str:
+    """Identify an embedding model, e.g. for keying cached vectors."""
+    name = type(embeddings).__name__
+    for attr in ["model", "model_name", "deployment", "size"]:
+        value = getattr(embeddings, attr, None)
+        if value is not None:
+            name += f":{value}"
+    return name
+
+
 def strip_citations(text: str) -> str:
     # Combined regex for identifying citations (see unit tests for examples)
     citation_regex = r"\b[\w\-]+\set\sal\.\s\([0-9]{4}\)|\((?:[^\)]*?[a-zA-Z][^\)]*?[0-9]{4}[^\)]*?)\)"
@@ -0,0 +1,696 @@
+import copy
+from pathlib import Path
+from typing import (
+    Any,
+    Iterable,
+    List,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+import numpy as np
+from langchain.docstore.base import Docstore
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.schema.embeddings import Embeddings
+from langchain.vectorstores import FAISS
+from langchain.vectorstores.faiss import dependable_faiss_import
+from langchain.vectorstores.utils import maximal_marginal_relevance
+
+
+class EmbeddingStore:
+    """Embeddings of many texts, as rows of one contiguous matrix.
+
+    Texts hold the index of their row instead of a list of floats, which is
+    roughly 8x smaller for float32 (16x for float16). Rows are appended in
+    amortized constant time and are only renumbered by ``compact``.
+    """
+
+    def __init__(self, dtype: Union[str, np.dtype] = "float32"):
+        self.dtype = np.dtype(dtype)
+        self._data = np.empty((0, 0), dtype=self.dtype)
+        self._size = 0
+
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray) -> "EmbeddingStore":
+        """Wrap a matrix (e.g. a memory-mapped one) without copying it.
+
+        It is copied before rows are first appended, so it is never written to.
+        """
+        store = cls(matrix.dtype)
+        store._data = matrix
+        store._size = len(matrix)
+        return store
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """A view (not a copy) of all the stored rows."""
+        return self._data[: self._size]
+
+    def __getitem__(self, rows: Union[int, Sequence[int], np.ndarray]) -> np.ndarray:
+        return self.matrix[rows]
+
+    def append(self, embeddings: Union[np.ndarray, Sequence[Sequence[float]]]) -> range:
+        """Store embeddings and return their rows."""
+        vectors = np.asarray(embeddings, dtype=self.dtype)
+        if vectors.ndim != 2:
+            raise ValueError("Embeddings must be a 2D array of vectors.")
+        if self._size == 0 and self._data.shape[1] != vectors.shape[1]:
+            self._data = np.empty((0, vectors.shape[1]), dtype=self.dtype)
+        if vectors.shape[1] != self._data.shape[1]:
+            raise ValueError(
+                f"Embeddings have dimension {vectors.shape[1]}, "
+                f"expected {self._data.shape[1]}."
+            )
+        start = self._size
+        stop = start + len(vectors)
+        if stop > len(self._data):
+            # grow geometrically so appending is amortized O(1) per row
+            data = np.empty(
+                (max(stop, 2 * len(self._data)), self._data.shape[1]), dtype=self.dtype
+            )
+            data[:start] = self._data[:start]
+            self._data = data
+        self._data[start:stop] = vectors
+        self._size = stop
+        return range(start, stop)
+
+    def compact(self, rows: Sequence[int]) -> None:
+        """Keep only the given rows, which become rows 0, 1, ... in that order."""
+        self._data = np.ascontiguousarray(self.matrix[np.asarray(rows, dtype=np.int64)])
+        self._size = len(self._data)
+
+    def __getstate__(self):
+        # spare capacity is not pickled
+        return {"dtype": self.dtype.str, "data": np.asarray(self.matrix)}
+
+    def __setstate__(self, state):
+        self.dtype = np.dtype(state["dtype"])
+        self._data = state["data"]
+        self._size = len(self._data)
+
+
+class Segment:
+    """A faiss index with ids that is never changed once made, so it can be shared."""
+
+    def __init__(self, index: Any):
+        self.index = index
+        self._ids: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_vectors(cls, like: Any, ids: np.ndarray, vectors: np.ndarray) -> "Segment":
+        """Make a segment of (normalized if need be) vectors, of the same kind as like."""
+        faiss = dependable_faiss_import()
+        index = faiss.IndexIDMap2(faiss.IndexFlat(like.d, like.metric_type))
+        if len(ids) > 0:
+            index.add_with_ids(
+                np.ascontiguousarray(vectors, dtype=np.float32),
+                np.asarray(ids, dtype=np.int64),
+            )
+        return cls(index)
+
+    @classmethod
+    def merge(cls, segments: Sequence["Segment"]) -> "Segment":
+        contents = [s.contents() for s in segments]
+        return cls.from_vectors(
+            segments[0].index,
+            np.concatenate([ids for ids, _ in contents]),
+            np.concatenate([vectors for _, vectors in contents]),
+        )
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    @property
+    def ids(self) -> np.ndarray:
+        """The segment's ids, sorted."""
+        if self._ids is None:
+            faiss = dependable_faiss_import()
+            self._ids = np.sort(faiss.vector_to_array(self.index.id_map))
+        return self._ids
+
+    def has(self, ids: np.ndarray) -> np.ndarray:
+        """Which of the ids are in the segment, as a boolean mask."""
+        positions = np.searchsorted(self.ids, ids)
+        found = positions < len(self.ids)
+        found[found] = self.ids[positions[found]] == ids[found]
+        return found
+
+    def contents(self) -> Tuple[np.ndarray, np.ndarray]:
+        """All the ids and vectors (read into memory), in the order they were added."""
+        faiss = dependable_faiss_import()
+        return (
+            faiss.vector_to_array(self.index.id_map),
+            self.index.index.reconstruct_n(0, self.ntotal),
+        )
+
+
+class IDMapFAISS(FAISS):
+    """A FAISS vector store whose vectors are labelled by stable integer ids.
+
+    The langchain FAISS store labels vectors by their position, so removing one
+    renumbers the rest. Here the ids passed when adding (which must be integers,
+    or strings of them) are the FAISS labels and never change. Deleted ids are
+    tombstoned and excluded from searches until ``compact`` physically removes them.
+
+    Vectors are kept in segments (see Segment), which are never changed once
+    made. Added vectors go in a new segment, and the newest segments are merged
+    while they are about as big as the one before, so there are O(log n) of
+    them. A copy of the store (see copy) shares them, so it can be changed
+    while this one is searched without copying the vectors.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        self.segments: List[Segment] = []
+        super().__init__(*args, **kwargs)
+        self.deleted: Set[int] = set()
+        self._deleted_selector: Any = None
+        # whether the first segment is memory-mapped (it is read from disk as needed)
+        self.mapped = False
+
+    @property  # type: ignore
+    def index(self) -> Any:
+        """The faiss index of all the vectors, merging the segments into one if need be."""
+        if len(self.segments) > 1:
+            self.segments = [Segment.merge(self.segments)]
+            self.mapped = False
+        return self.segments[0].index
+
+    @index.setter
+    def index(self, index: Any) -> None:
+        self.segments = [Segment(index)]
+
+    @property
+    def ntotal(self) -> int:
+        """How many vectors there are, including tombstoned ones."""
+        return sum(s.ntotal for s in self.segments)
+
+    @classmethod
+    def from_embeddings(
+        cls,
+        text_embeddings: Iterable[Tuple[str, List[float]]],
+        embedding: Embeddings,
+        metadatas: Optional[Iterable[dict]] = None,
+        ids: Optional[List[Any]] = None,
+        **kwargs: Any,
+    ) -> "IDMapFAISS":
+        texts, embeddings = zip(*text_embeddings)
+        return cls.from_vectors(
+            list(texts),
+            np.array(embeddings, dtype=np.float32),
+            embedding,
+            metadatas=metadatas,
+            ids=ids,
+            **kwargs,
+        )
+
+    @classmethod
+    def from_vectors(
+        cls,
+        texts: List[str],
+        vectors: np.ndarray,
+        embedding: Embeddings,
+        metadatas: Optional[Iterable[dict]] = None,
+        ids: Optional[List[Any]] = None,
+        **kwargs: Any,
+    ) -> "IDMapFAISS":
+        """Create a store from a matrix with one row per text (e.g. an EmbeddingStore's)."""
+        faiss = dependable_faiss_import()
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(vectors.shape[1]))
+        vecstore = cls(embedding.embed_query, index, InMemoryDocstore(), {}, **kwargs)
+        vecstore.add_vectors(
+            texts,
+            vectors,
+            metadatas=list(metadatas) if metadatas is not None else None,
+            ids=ids,
+        )
+        return vecstore
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[Any]] = None,
+        **kwargs: Any,
+    ) -> "IDMapFAISS":
+        embeddings = embedding.embed_documents(texts)
+        return cls.from_embeddings(
+            list(zip(texts, embeddings)), embedding, metadatas=metadatas, ids=ids
+        )
+
+    @classmethod
+    def load_mapped(
+        cls,
+        index_file: Union[str, Path],
+        embedding: Embeddings,
+        docstore: Docstore,
+        index_to_docstore_id: MutableMapping[int, str],
+    ) -> "IDMapFAISS":
+        """Open a saved faiss index without reading its vectors into memory.
+
+        Falls back to reading it in full with faiss versions that cannot
+        memory-map flat indexes.
+        """
+        faiss = dependable_faiss_import()
+        flag = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+        if flag is None:
+            index = faiss.read_index(str(index_file))
+        else:
+            index = faiss.read_index(str(index_file), flag)
+        vecstore = cls(
+            embedding.embed_query,
+            index,
+            docstore,
+            index_to_docstore_id,  # type: ignore
+        )
+        vecstore.mapped = flag is not None
+        return vecstore
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[Any]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        embeddings = [self.embedding_function(text) for text in texts]
+        return self.add_embeddings(
+            list(zip(texts, embeddings)), metadatas=metadatas, ids=ids
+        )
+
+    def add_embeddings(
+        self,
+        text_embeddings: Iterable[Tuple[str, List[float]]],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[Any]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts, embeddings = zip(*text_embeddings)
+        return self.add_vectors(
+            list(texts),
+            np.array(embeddings, dtype=np.float32),
+            metadatas=metadatas,
+            ids=ids,
+        )
+
+    def add_vectors(
+        self,
+        texts: List[str],
+        vectors: np.ndarray,
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[Any]] = None,
+    ) -> List[str]:
+        """Add texts with their embeddings given as a matrix, one row per text.
+
+        A contiguous float32 matrix is passed to faiss as is, without copying.
+        """
+        faiss = dependable_faiss_import()
+        if ids is None:
+            start = max(self.index_to_docstore_id, default=-1) + 1
+            ids = list(range(start, start + len(texts)))
+        int_ids = [int(i) for i in ids]
+        _metadatas = metadatas or [{} for _ in texts]
+        if not len(texts) == len(vectors) == len(_metadatas) == len(int_ids):
+            raise ValueError(
+                "texts, vectors, metadatas and ids must have the same length."
+            )
+        vector = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self._normalize_L2:
+            # normalizes in place, so work on a copy
+            vector = vector.copy()
+            faiss.normalize_L2(vector)
+        segment = Segment.from_vectors(
+            self.segments[0].index, np.array(int_ids, dtype=np.int64), vector
+        )
+        segments = [s for s in self.segments if s.ntotal > 0]
+        while segments and segments[-1].ntotal <= 2 * segment.ntotal:
+            # merged segments are new, the ones merged may still be searched
+            if segments[-1] is self.segments[0]:
+                self.mapped = False
+            segment = Segment.merge([segments.pop(), segment])
+        self.segments = [*segments, segment]
+        # the docstore and id map are shared with copies, but only added to
+        self.docstore.add(
+            {
+                str(i): Document(page_content=t, metadata=m)
+                for i, t, m in zip(int_ids, texts, _metadatas)
+            }
+        )
+        self.index_to_docstore_id.update({i: str(i) for i in int_ids})
+        return [str(i) for i in int_ids]
+
+    def delete(self, ids: Optional[List[Any]] = None, **kwargs: Any) -> Optional[bool]:
+        """Tombstone ids, so they are no longer returned by searches."""
+        if ids is None:
+            raise ValueError("No ids provided to delete.")
+        self.deleted.update(int(i) for i in ids if int(i) in self.index_to_docstore_id)
+        self._deleted_selector = None
+        return True
+
+    def copy(self) -> "IDMapFAISS":
+        """Copy the store, so the copy can be changed while this one is searched.
+
+        Nothing is copied in bulk. Segments are never changed, and the docstore
+        and id map are only added to (with ids this store does not search)
+        until compact replaces them.
+        """
+        store = copy.copy(self)
+        store.segments = list(self.segments)
+        store.deleted = set(self.deleted)
+        store._deleted_selector = None
+        return store
+
+    @property
+    def has_ids(self) -> bool:
+        """False if this wraps an index saved by the plain langchain FAISS store."""
+        faiss = dependable_faiss_import()
+        return isinstance(self.segments[0].index, faiss.IndexIDMap2)
+
+    @property
+    def deleted_fraction(self) -> float:
+        if self.ntotal == 0:
+            return 0.0
+        return len(self.deleted) / self.ntotal
+
+    def compact(self) -> None:
+        """Physically remove tombstoned vectors from the index and docstore.
+
+        The segments, docstore and id map are replaced, not changed, as copies
+        of the store may share them.
+        """
+        if len(self.deleted) == 0:
+            return
+        deleted = np.array(sorted(self.deleted), dtype=np.int64)
+        contents = [s.contents() for s in self.segments]
+        ids = np.concatenate([ids for ids, _ in contents])
+        vectors = np.concatenate([vectors for _, vectors in contents])
+        keep = ~np.isin(ids, deleted)
+        self.segments = [
+            Segment.from_vectors(self.segments[0].index, ids[keep], vectors[keep])
+        ]
+        self.mapped = False
+        removed = {self.index_to_docstore_id[i] for i in self.deleted}
+        if isinstance(self.docstore, InMemoryDocstore):
+            self.docstore = InMemoryDocstore(
+                {k: d for k, d in self.docstore._dict.items() if k not in removed}
+            )
+        else:
+            self.docstore = self.docstore.copy()  # type: ignore
+            self.docstore.delete(list(removed))
+        id_map = self.index_to_docstore_id.copy()  # type: ignore
+        for i in self.deleted:
+            del id_map[i]
+        self.index_to_docstore_id = id_map
+        self.deleted = set()
+        self._deleted_selector = None
+
+    @classmethod
+    def from_index(
+        cls,
+        index: Union[bytes, Any],
+        embedding: Embeddings,
+        texts: List[str],
+        metadatas: List[dict],
+        ids: List[int],
+    ) -> "IDMapFAISS":
+        """Wrap a (serialized) faiss index with a docstore of the texts of its ids."""
+        if isinstance(index, bytes):
+            faiss = dependable_faiss_import()
+            index = faiss.deserialize_index(np.frombuffer(index, dtype=np.uint8))
+        docstore = InMemoryDocstore(
+            {
+                str(i): Document(page_content=t, metadata=m)
+                for i, t, m in zip(ids, texts, metadatas)
+            }
+        )
+        return cls(embedding.embed_query, index, docstore, {i: str(i) for i in ids})
+
+    @property
+    def ids(self) -> Set[int]:
+        """The ids of the vectors in the faiss index (including tombstoned ones)."""
+        return {int(i) for s in self.segments for i in s.ids}
+
+    def serialize_index(self) -> bytes:
+        """Return the faiss index (not the docstore) as bytes, see from_index."""
+        faiss = dependable_faiss_import()
+        self.compact()
+        return faiss.serialize_index(self.index).tobytes()
+
+    def save_index(self, index_file: Union[str, Path]) -> None:
+        """Save only the faiss index (not the docstore), to be opened with load_mapped."""
+        faiss = dependable_faiss_import()
+        self.compact()
+        faiss.write_index(self.index, str(index_file))
+
+    def save_local(self, folder_path: str, index_name: str = "index") -> None:
+        # tombstones are not saved, so remove them for good first
+        self.compact()
+        super().save_local(folder_path, index_name=index_name)
+
+    def _search(
+        self,
+        embedding: List[float],
+        k: int,
+        id_ranges: Optional[List[Tuple[int, int]]] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search, optionally only among ids in the given [start, stop) ranges."""
+        faiss = dependable_faiss_import()
+        vector = np.array([embedding], dtype=np.float32)
+        if self._normalize_L2:
+            faiss.normalize_L2(vector)
+        if id_ranges is not None:
+            ids = np.concatenate(
+                [np.arange(*r, dtype=np.int64) for r in id_ranges]
+                + [np.array([], dtype=np.int64)]
+            )
+            ids = ids[[int(i) in self.index_to_docstore_id for i in ids]]
+            if len(self.deleted) > 0:
+                ids = ids[[int(i) not in self.deleted for i in ids]]
+            if 2 * len(ids) < self.ntotal:
+                return self._search_subset(vector[0], k, ids)
+            selector: Any = faiss.IDSelectorBatch(ids)
+            params = faiss.SearchParameters(sel=selector)
+            return self._search_segments(vector, k, params=params)
+        return self._search_many(vector, k)
+
+    def _search_segments(
+        self, vectors: np.ndarray, k: int, params: Any = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search every segment, merging their results into the k best for each row."""
+        faiss = dependable_faiss_import()
+        results = [s.index.search(vectors, k, params=params) for s in self.segments]
+        if len(results) == 1:
+            return results[0]
+        scores = np.hstack([scores for scores, _ in results])
+        indices = np.hstack([indices for _, indices in results])
+        # missing results have the worst possible score, so they come last
+        if self.segments[0].index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        else:
+            order = np.argsort(scores, axis=1, kind="stable")[:, :k]
+        return (
+            np.take_along_axis(scores, order, axis=1),
+            np.take_along_axis(indices, order, axis=1),
+        )
+
+    def _reconstruct(self, ids: Union[Sequence[int], np.ndarray]) -> np.ndarray:
+        """Return the (normalized if need be) vectors of ids, from their segments."""
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.empty((len(ids), self.segments[0].index.d), dtype=np.float32)
+        for segment in self.segments:
+            found = segment.has(ids)
+            if found.any():
+                vectors[found] = segment.index.reconstruct_batch(ids[found])
+        return vectors
+
+    def _search_many(
+        self, vectors: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search for each row of a (normalized if need be) matrix, skipping deleted ids."""
+        faiss = dependable_faiss_import()
+        if len(self.deleted) == 0:
+            return self._search_segments(vectors, k)
+        if self._deleted_selector is None:
+            batch = faiss.IDSelectorBatch(np.array(list(self.deleted), dtype=np.int64))
+            # keep a reference to batch so it is not freed before the selector
+            self._deleted_selector = (faiss.IDSelectorNot(batch), batch)
+        params = faiss.SearchParameters(sel=self._deleted_selector[0])
+        return self._search_segments(vectors, k, params=params)
+
+    def _search_subset(
+        self, vector: np.ndarray, k: int, ids: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact L2 search over only some ids, in time proportional to their number."""
+        scores = np.full((1, k), np.inf, dtype=np.float32)
+        indices = np.full((1, k), -1, dtype=np.int64)
+        if len(ids) == 0:
+            return scores, indices
+        vectors = self._reconstruct(ids)
+        distances = ((vectors - vector) ** 2).sum(axis=1)
+        top = np.argsort(distances)[:k]
+        scores[0, : len(top)] = distances[top]
+        indices[0, : len(top)] = ids[top]
+        return scores, indices
+
+    def _docs_for(self, indices: Iterable[int]) -> List[Document]:
+        """Return the documents with the given ids, with the id in their metadata.
+
+        Names need not be unique, so the id is what tells results apart (e.g.
+        when fusing rankings). Stored documents are copied, not changed.
+        """
+        docs = []
+        for i in indices:
+            _id = self.index_to_docstore_id[i]
+            doc = self.docstore.search(_id)
+            if not isinstance(doc, Document):
+                raise ValueError(f"Could not find document for id {_id}, got {doc}")
+            docs.append(
+                Document(
+                    page_content=doc.page_content,
+                    metadata={**doc.metadata, "id": int(i)},
+                )
+            )
+        return docs
+
+    def get_by_ids(self, ids: Iterable[int]) -> List[Document]:
+        """Return the documents with the given ids, skipping unknown or deleted ones."""
+        return self._docs_for(
+            i for i in ids if i in self.index_to_docstore_id and i not in self.deleted
+        )
+
+    @staticmethod
+    def _matches_filter(doc: Document, filter: Optional[dict]) -> bool:
+        if filter is None:
+            return True
+        return all(
+            doc.metadata.get(key) in value
+            if isinstance(value, list)
+            else doc.metadata.get(key) == value
+            for key, value in filter.items()
+        )
+
+    def similarity_search_with_score_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[dict] = None,
+        fetch_k: int = 20,
+        id_ranges: Optional[List[Tuple[int, int]]] = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        """Return docs most similar to the embedding.
+
+        If id_ranges is given, only vectors with ids in those [start, stop)
+        ranges are searched (exactly, with no over-fetching).
+        """
+        scores, indices = self._search(
+            embedding, k if filter is None else fetch_k, id_ranges=id_ranges
+        )
+        found = [(i, s) for i, s in zip(indices[0], scores[0]) if i != -1]
+        docs = self._docs_for([i for i, _ in found])
+        return [
+            (doc, s)
+            for doc, (_, s) in zip(docs, found)
+            if self._matches_filter(doc, filter)
+        ][:k]
+
+    def max_marginal_relevance_search_with_score_by_vector(
+        self,
+        embedding: List[float],
+        *,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[dict] = None,
+        id_ranges: Optional[List[Tuple[int, int]]] = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        scores, indices = self._search(
+            embedding, fetch_k if filter is None else fetch_k * 2, id_ranges=id_ranges
+        )
+        found = [(i, s) for i, s in zip(indices[0], scores[0]) if i != -1]
+        docs = self._docs_for([i for i, _ in found])
+        found_docs = [
+            (i, s, doc)
+            for (i, s), doc in zip(found, docs)
+            if self._matches_filter(doc, filter)
+        ]
+        if len(found_docs) == 0:
+            return []
+        embeddings = list(self._reconstruct([i for i, _, _ in found_docs]))
+        mmr_selected = maximal_marginal_relevance(
+            np.array([embedding], dtype=np.float32),
+            embeddings,
+            k=k,
+            lambda_mult=lambda_mult,
+        )
+        return [(found_docs[j][2], found_docs[j][1]) for j in mmr_selected]
+
+    def max_marginal_relevance_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[dict] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        docs_and_scores = self.max_marginal_relevance_search_with_score_by_vector(
+            embedding,
+            k=k,
+            fetch_k=fetch_k,
+            lambda_mult=lambda_mult,
+            filter=filter,
+            **kwargs,
+        )
+        return [doc for doc, _ in docs_and_scores]
+
+    def search_many_by_vectors(
+        self,
+        embeddings: Union[np.ndarray, Sequence[Sequence[float]]],
+        k: int = 4,
+        fetch_k: int = 20,
+        marginal_relevance: bool = False,
+        lambda_mult: float = 0.5,
+    ) -> List[List[Document]]:
+        """Return the docs most similar to each embedding, searching for all at once.
+
+        The same as similarity_search_by_vector (or, with marginal_relevance,
+        max_marginal_relevance_search_by_vector) for each embedding, but faiss
+        goes through the index once for the whole matrix of them.
+        """
+        faiss = dependable_faiss_import()
+        queries = np.array(embeddings, dtype=np.float32)
+        if len(queries) == 0:
+            return []
+        vectors = queries
+        if self._normalize_L2:
+            # normalizes in place, so work on a copy
+            vectors = queries.copy()
+            faiss.normalize_L2(vectors)
+        _, indices = self._search_many(vectors, fetch_k if marginal_relevance else k)
+        results = []
+        for query, row in zip(queries, indices):
+            found = row[row != -1]
+            docs = self._docs_for(found.tolist())
+            if marginal_relevance and len(docs) > 0:
+                selected = maximal_marginal_relevance(
+                    query[None, :],
+                    self._reconstruct(found),
+                    k=k,
+                    lambda_mult=lambda_mult,
+                )
+                docs = [docs[j] for j in selected]
+            results.append(docs[:k])
+        return results